@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+import logging
+from contextlib import nullcontext
+from typing import Dict, Iterable, Sequence
+
+from psycopg import Pipeline
+from sqlalchemy import make_url, text
+from sqlalchemy.engine import Connection
+
+logger = logging.getLogger(__name__)
+
+# 暂存表中记录写入顺序的列，用于同一批次内重复键时保留最后一行
+_ORD_COLUMN = "_ord"
+
+
+def supports_copy(conn: Connection) -> bool:
+    """Whether rows can be streamed into this connection with psycopg's COPY."""
+    return conn.dialect.name == "postgresql" and conn.dialect.driver == "psycopg"
+
+
+def driver_connect_args(url: str) -> Dict[str, object]:
+    """Extra DBAPI connect arguments for the driver named in `url`."""
+    if make_url(url).get_driver_name() == "psycopg":
+        # 暂存表的建表、合并、清空语句每批都会重复执行：首次执行即服务端预备，
+        # 后续批次复用解析与计划结果（psycopg 默认要执行 5 次后才预备）
+        return {"prepare_threshold": 0}
+    return {}
+
+
+class StagedUpsert:
+    """Prebuilt statements that upsert one table through a temporary staging table.
+
+    Each row holds the values of `columns` in order. When a key repeats the last
+    row wins, as with consecutive single-row upserts. With `match`, a row whose
+    `match` columns equal an existing row reuses that row's `conflict` column
+    (its id) instead of the value supplied. An empty `update` leaves
+    conflicting rows untouched (DO NOTHING).
+
+    With `binary`, psycopg loads the stage with binary COPY typed from the
+    stage's own columns. Every value must then already have the Python type of
+    its column (uuid.UUID for uuid, list for arrays, and so on), so only enable
+    it for rows built entirely by the migration rather than passed through
+    from the source.
+    """
+
+    __slots__ = (
+        "table",
+        "columns",
+        "stage",
+        "binary",
+        "_create_stage",
+        "_reset_stage",
+        "_copy_stage",
+        "_copy_stage_binary",
+        "_select_stage_types",
+        "_insert_stage",
+        "_params",
+        "_merge",
+        "_truncate_stage",
+    )
+
+    def __init__(
+        self,
+        table: str,
+        columns: Sequence[str],
+        *,
+        conflict: Sequence[str],
+        update: Sequence[str],
+        match: Sequence[str] = (),
+        binary: bool = False,
+    ) -> None:
+        self.table = table
+        self.binary = binary
+        self.columns = tuple(columns)
+        self.stage = f"{table}_stage"
+        column_list = ", ".join(columns)
+
+        # 暂存表只复制列类型（不含约束），随事务结束自动删除；同一事务内复用，
+        # 每批写入前清空上一批的数据
+        create_stage = (
+            f"CREATE TEMP TABLE IF NOT EXISTS {self.stage} ON COMMIT DROP AS "
+            f"SELECT {column_list}, CAST(NULL AS bigint) AS {_ORD_COLUMN} "
+            f"FROM {table} WITH NO DATA"
+        )
+        truncate_stage = f"TRUNCATE {self.stage}"
+        self._create_stage = text(create_stage)
+        self._truncate_stage = text(truncate_stage)
+        self._reset_stage = (create_stage, truncate_stage)
+        self._copy_stage = (
+            f"COPY {self.stage} ({column_list}, {_ORD_COLUMN}) FROM STDIN"
+        )
+        self._copy_stage_binary = f"{self._copy_stage} (FORMAT BINARY)"
+        # 暂存表由 CREATE TABLE AS 按 columns + _ord 的顺序建列，列号即写入顺序
+        self._select_stage_types = (
+            f"SELECT atttypid FROM pg_attribute "
+            f"WHERE attrelid = '{self.stage}'::regclass "
+            f"AND attnum > 0 AND NOT attisdropped ORDER BY attnum"
+        )
+        self._params = [f"p{index}" for index in range(len(columns))]
+        placeholders = ", ".join(f":{name}" for name in self._params)
+        self._insert_stage = text(
+            f"INSERT INTO {self.stage} ({column_list}, {_ORD_COLUMN}) "
+            f"VALUES ({placeholders}, :{_ORD_COLUMN})"
+        )
+
+        keys = match or conflict
+        if match:
+            selected = [
+                (
+                    f"COALESCE(e.{column}, s.{column})"
+                    if column in conflict
+                    else f"s.{column}"
+                )
+                for column in columns
+            ]
+            source = f"{self.stage} s LEFT JOIN {table} e ON " + " AND ".join(
+                f"e.{column} = s.{column}" for column in match
+            )
+        else:
+            selected = [f"s.{column}" for column in columns]
+            source = f"{self.stage} s"
+        key_list = ", ".join(f"s.{column}" for column in keys)
+        # 没有需要更新的列时冲突行原样保留，RETURNING 只返回新插入的行
+        if update:
+            action = "DO UPDATE SET " + ", ".join(
+                f"{column} = EXCLUDED.{column}" for column in update
+            )
+        else:
+            action = "DO NOTHING"
+        # xmax = 0 表示该行由本条语句新插入，否则为冲突后更新
+        self._merge = text(
+            f"WITH upserted AS ("
+            f"INSERT INTO {table} ({column_list}) "
+            f"SELECT DISTINCT ON ({key_list}) {', '.join(selected)} FROM {source} "
+            f"ORDER BY {key_list}, s.{_ORD_COLUMN} DESC "
+            f"ON CONFLICT ({', '.join(conflict)}) {action} "
+            f"RETURNING (xmax = 0) AS inserted"
+            f") SELECT count(*) FILTER (WHERE inserted) FROM upserted"
+        )
+
+    def execute(self, conn: Connection, rows: Iterable[Sequence]) -> int:
+        """Upsert `rows` and return how many were inserted rather than updated."""
+        self._load_stage(conn, rows)
+        inserted = conn.execute(self._merge).scalar_one()
+        logger.debug(
+            "已通过暂存表 %s 写入 %s：新增 %s 条", self.stage, self.table, inserted
+        )
+        return inserted
+
+    def _load_stage(self, conn: Connection, rows: Iterable[Sequence]) -> None:
+        if supports_copy(conn):
+            raw = conn.connection.driver_connection
+            # 建表、清空（以及二进制 COPY 所需的列类型查询）无需等待各自的结果，
+            # libpq 支持时放进同一个 pipeline 一次往返
+            with raw.pipeline() if Pipeline.is_supported() else nullcontext():
+                for statement in self._reset_stage:
+                    raw.execute(statement)
+                if self.binary:
+                    stage_types = raw.execute(self._select_stage_types)
+            types = None
+            if self.binary:
+                types = [oid for (oid,) in stage_types.fetchall()]
+                # 含驱动不认识的类型（如自定义枚举）时无法按二进制编码，退回文本 COPY
+                if not all(raw.adapters.types.get(oid) for oid in types):
+                    types = None
+            statement = self._copy_stage if types is None else self._copy_stage_binary
+            with raw.cursor() as cursor:
+                with cursor.copy(statement) as copy:
+                    if types is not None:
+                        copy.set_types(types)
+                    for ordinal, row in enumerate(rows):
+                        copy.write_row((*row, ordinal))
+            return
+
+        # 其他驱动：executemany 写入暂存表，合并语句与 COPY 路径共用
+        conn.execute(self._create_stage)
+        conn.execute(self._truncate_stage)
+        payload = [
+            {**dict(zip(self._params, row)), _ORD_COLUMN: ordinal}
+            for ordinal, row in enumerate(rows)
+        ]
+        if payload:
+            conn.execute(self._insert_stage, payload)
+
+
+def copy_upsert(
+    conn: Connection,
+    *,
+    table: str,
+    columns: Sequence[str],
+    rows: Iterable[Sequence],
+    conflict: Sequence[str],
+    update: Sequence[str],
+    match: Sequence[str] = (),
+) -> int:
+    """One-off `StagedUpsert`; returns how many rows were inserted."""
+    upsert = StagedUpsert(table, columns, conflict=conflict, update=update, match=match)
+    return upsert.execute(conn, rows)
+
+
+__all__ = ["StagedUpsert", "copy_upsert", "driver_connect_args", "supports_copy"]
@@ -1,15 +1,84 @@
 from __future__ import annotations
 
+import ctypes
+import errno
+import functools
 import logging
-import shutil
+import os
+import stat
+import sys
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
+from typing import Callable, Deque, Iterator, List, Optional, Set, Tuple
 
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine
 from sqlalchemy.engine import Connection
 
 logger = logging.getLogger(__name__)
 
+_ID_FETCH_SIZE = 10_000
+# 每个线程池任务负责复制的文件数，摊薄任务提交与 Future 的开销
+_COPY_TASK_SIZE = 256
+_COPY_BUFSIZE = 1 << 20
+# 每个复制线程各自持有一块 _COPY_BUFSIZE 缓冲区，在文件之间复用
+_thread_local = threading.local()
+_COPY_BLOCKSIZE = 1 << 23
+_READ_FLAGS = os.O_RDONLY | getattr(os, "O_BINARY", 0) | getattr(os, "O_CLOEXEC", 0)
+# 另按是否覆盖追加 O_TRUNC 或 O_EXCL，由 open 一次完成存在性检查与创建
+_WRITE_FLAGS = (
+    os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0) | getattr(os, "O_CLOEXEC", 0)
+)
+# 内核拷贝不可用（跨文件系统、内核过旧、文件系统不支持等）时降级的错误码。
+_FALLBACK_ERRNOS = frozenset(
+    code
+    for code in (
+        getattr(errno, name, None)
+        for name in ("EXDEV", "ENOSYS", "EINVAL", "ENOTSUP", "EOPNOTSUPP", "ENOTSOCK")
+    )
+    if code is not None
+)
+
+_AT_FDCWD = -100
+_AT_STATX_DONT_SYNC = 0x4000
+_STATX_TYPE = 0x0001
+
+
+class _StatxTimestamp(ctypes.Structure):
+    _fields_ = [
+        ("tv_sec", ctypes.c_int64),
+        ("tv_nsec", ctypes.c_uint32),
+        ("__reserved", ctypes.c_int32),
+    ]
+
+
+class _Statx(ctypes.Structure):
+    _fields_ = [
+        ("stx_mask", ctypes.c_uint32),
+        ("stx_blksize", ctypes.c_uint32),
+        ("stx_attributes", ctypes.c_uint64),
+        ("stx_nlink", ctypes.c_uint32),
+        ("stx_uid", ctypes.c_uint32),
+        ("stx_gid", ctypes.c_uint32),
+        ("stx_mode", ctypes.c_uint16),
+        ("__spare0", ctypes.c_uint16),
+        ("stx_ino", ctypes.c_uint64),
+        ("stx_size", ctypes.c_uint64),
+        ("stx_blocks", ctypes.c_uint64),
+        ("stx_attributes_mask", ctypes.c_uint64),
+        ("stx_atime", _StatxTimestamp),
+        ("stx_btime", _StatxTimestamp),
+        ("stx_ctime", _StatxTimestamp),
+        ("stx_mtime", _StatxTimestamp),
+        ("stx_rdev_major", ctypes.c_uint32),
+        ("stx_rdev_minor", ctypes.c_uint32),
+        ("stx_dev_major", ctypes.c_uint32),
+        ("stx_dev_minor", ctypes.c_uint32),
+        ("__spare2", ctypes.c_uint64 * 14),
+    ]
+
 
 @dataclass(slots=True)
 class CopyImageConfig:
@@ -19,6 +88,7 @@ class CopyImageConfig:
     target_dir: Path
     leporid_url: str
     overwrite: bool = False
+    workers: int = 8
 
 
 @dataclass(slots=True)
@@ -43,10 +113,11 @@ def run_copy_img(config: CopyImageConfig) -> CopyImageStats:
     target_dir.mkdir(parents=True, exist_ok=True)
 
     logger.info(
-        "开始复制图片，source_dir=%s target_dir=%s overwrite=%s",
+        "开始复制图片，source_dir=%s target_dir=%s overwrite=%s workers=%s",
         source_dir,
         target_dir,
         config.overwrite,
+        config.workers,
     )
 
     engine = create_engine(config.leporid_url, pool_pre_ping=True)
@@ -57,6 +128,7 @@ def run_copy_img(config: CopyImageConfig) -> CopyImageStats:
                 source_dir=source_dir,
                 target_dir=target_dir,
                 overwrite=config.overwrite,
+                workers=config.workers,
             )
     finally:
         engine.dispose()
@@ -68,35 +140,49 @@ def _copy_images(
     source_dir: Path,
     target_dir: Path,
     overwrite: bool,
+    workers: int = 8,
 ) -> CopyImageStats:
     stats = CopyImageStats()
 
-    stmt = text("SELECT id FROM tbl_image ORDER BY id").execution_options(
-        stream_results=True
-    )
-    rows = conn.execute(stmt)
-
-    for row in rows:
-        stats.processed += 1
-        image_id = str(row.id)
-        filename = f"{image_id}.webp"
-        src_path = source_dir / filename
-        if not src_path.is_file():
-            stats.skipped_missing += 1
-            logger.debug("跳过 %s：源文件缺失", filename)
-            continue
-
-        dst_path = target_dir / filename
-        if dst_path.exists() and not overwrite:
-            stats.skipped_existing += 1
-            logger.debug("跳过 %s：目标已存在", filename)
-            continue
-
-        if overwrite and dst_path.exists():
-            dst_path.unlink()
-
-        shutil.copy2(src_path, dst_path)
-        stats.copied += 1
+    # 预先用 scandir 列出源目录，循环中只做集合查找，不再逐个文件 stat。
+    # 目标是否已存在交给 O_EXCL 判断，无需再扫描目标目录。
+    available = _list_files(source_dir)
+    # Path 仅用于接口边界，循环内直接拼接字符串路径，免去逐个构造 Path 对象。
+    src_root = os.fspath(source_dir)
+    dst_root = os.fspath(target_dir)
+    # 逐个文件的调试日志只在开启 DEBUG 时输出，循环内免去参数打包
+    debug = logger.isEnabledFor(logging.DEBUG)
+
+    # 查询结果在主线程中按批读取，每凑满一批文件就整批提交给线程池复制；
+    # 在途任务数限制为 workers 的两倍，避免一次性堆积全部任务。
+    pending: Deque[Future[Tuple[int, int]]] = deque()
+    batch: List[Tuple[str, str]] = []
+    with ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="copy-img"
+    ) as executor:
+        for chunk in _iter_image_id_chunks(conn):
+            for (image_id,) in chunk:
+                stats.processed += 1
+                filename = f"{image_id}.webp"
+                if filename not in available:
+                    stats.skipped_missing += 1
+                    if debug:
+                        logger.debug("跳过 %s：源文件缺失", filename)
+                    continue
+
+                batch.append(
+                    (os.path.join(src_root, filename), os.path.join(dst_root, filename))
+                )
+                if len(batch) >= _COPY_TASK_SIZE:
+                    pending.append(executor.submit(_copy_batch, batch, overwrite))
+                    batch = []
+                    if len(pending) >= 2 * workers:
+                        _record_batch(stats, pending.popleft())
+
+        if batch:
+            pending.append(executor.submit(_copy_batch, batch, overwrite))
+        while pending:
+            _record_batch(stats, pending.popleft())
 
     logger.info(
         "复制完成：total=%s copied=%s missing=%s existing=%s",
@@ -109,6 +195,163 @@ def _copy_images(
     return stats
 
 
+def _iter_image_id_chunks(conn: Connection) -> Iterator[List[tuple]]:
+    # 单列流式查询直接走 DBAPI 游标，跳过 SQLAlchemy 逐行构造 Row 的开销。
+    # PostgreSQL 使用具名（服务端）游标，其他驱动按 fetchmany 分批读取。
+    dbapi_conn = conn.connection.driver_connection
+    if conn.dialect.driver in ("psycopg", "psycopg2"):
+        cursor = dbapi_conn.cursor("copy_img_cursor")
+    else:
+        cursor = dbapi_conn.cursor()
+    cursor.arraysize = _ID_FETCH_SIZE
+    try:
+        cursor.execute("SELECT id FROM tbl_image ORDER BY id")
+        while chunk := cursor.fetchmany(_ID_FETCH_SIZE):
+            yield chunk
+    finally:
+        cursor.close()
+
+
+def _list_files(directory: Path) -> Set[str]:
+    # DirEntry 直接复用 readdir 返回的类型信息，仅符号链接才需要额外查询目标类型。
+    with os.scandir(directory) as entries:
+        return {
+            entry.name
+            for entry in entries
+            if entry.is_file(follow_symlinks=False)
+            or (entry.is_symlink() and _is_file_fast(entry.path))
+        }
+
+
+def _is_file_fast(path: str) -> bool:
+    mode = _maybe_statx(os.fsencode(path))
+    if mode is None:
+        try:
+            mode = os.stat(path).st_mode
+        except OSError:
+            return False
+    return stat.S_ISREG(mode)
+
+
+def _maybe_statx(path: bytes) -> Optional[int]:
+    """Return the file mode via statx(STATX_TYPE), or ``None`` if unusable."""
+
+    statx = _load_statx()
+    if statx is None:
+        return None
+
+    buf = _Statx()
+    # 与 Path.is_file() 一致：跟随符号链接，只请求文件类型且不强制同步元数据。
+    if statx(_AT_FDCWD, path, _AT_STATX_DONT_SYNC, _STATX_TYPE, ctypes.byref(buf)):
+        if ctypes.get_errno() in (errno.ENOSYS, errno.EPERM):
+            return None
+        return 0
+    if not buf.stx_mask & _STATX_TYPE:
+        return None
+    return buf.stx_mode
+
+
+@functools.lru_cache(maxsize=None)
+def _load_statx() -> Optional[Callable[..., int]]:
+    # statx 需要 Linux 4.11+ 与 glibc 2.28+，其他平台或旧环境回退到 os.stat。
+    if sys.platform != "linux":
+        return None
+    try:
+        statx = ctypes.CDLL(None, use_errno=True).statx
+    except (OSError, AttributeError):
+        return None
+    statx.argtypes = [
+        ctypes.c_int,
+        ctypes.c_char_p,
+        ctypes.c_int,
+        ctypes.c_uint,
+        ctypes.POINTER(_Statx),
+    ]
+    statx.restype = ctypes.c_int
+    return statx
+
+
+def _copy_batch(pairs: List[Tuple[str, str]], overwrite: bool) -> Tuple[int, int]:
+    """Copy every (source, target) pair, returning (copied, skipped_existing)."""
+    copied = 0
+    debug = logger.isEnabledFor(logging.DEBUG)
+    for src_path, dst_path in pairs:
+        if _fast_copy(src_path, dst_path, overwrite):
+            copied += 1
+        elif debug:
+            logger.debug("跳过 %s：目标已存在", os.path.basename(dst_path))
+    return copied, len(pairs) - copied
+
+
+def _record_batch(stats: CopyImageStats, future: Future[Tuple[int, int]]) -> None:
+    copied, skipped_existing = future.result()
+    stats.copied += copied
+    stats.skipped_existing += skipped_existing
+
+
+def _fast_copy(src_path: str, dst_path: str, overwrite: bool) -> bool:
+    """Copy file contents and timestamps, preferring in-kernel copies.
+
+    Returns ``False`` without touching the target if it exists and ``overwrite`` is off.
+    """
+
+    flags = _WRITE_FLAGS | (os.O_TRUNC if overwrite else os.O_EXCL)
+    src_fd = os.open(src_path, _READ_FLAGS)
+    try:
+        st = os.fstat(src_fd)
+        try:
+            dst_fd = os.open(dst_path, flags, stat.S_IMODE(st.st_mode))
+        except FileExistsError:
+            return False
+        try:
+            _copy_fd(src_fd, dst_fd, max(st.st_size, _COPY_BLOCKSIZE))
+            if os.utime in os.supports_fd:
+                os.utime(dst_fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+        except BaseException:
+            # 不保留写了一半的文件，否则下次运行会被 O_EXCL 当作已存在而跳过
+            os.close(dst_fd)
+            os.unlink(dst_path)
+            raise
+        os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+    if os.utime not in os.supports_fd:
+        os.utime(dst_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    return True
+
+
+def _copy_fd(src_fd: int, dst_fd: int, blocksize: int) -> None:
+    # 依次尝试 copy_file_range（CoW/NFS 服务端拷贝）、sendfile，最后才回退到用户态读写。
+    # 这些调用都会推进两端的文件偏移量，因此中途降级也能从当前位置继续。
+    if hasattr(os, "copy_file_range"):
+        try:
+            while os.copy_file_range(src_fd, dst_fd, blocksize):
+                pass
+            return
+        except OSError as exc:
+            if exc.errno not in _FALLBACK_ERRNOS:
+                raise
+
+    if hasattr(os, "sendfile"):
+        try:
+            while os.sendfile(dst_fd, src_fd, None, blocksize):
+                pass
+            return
+        except OSError as exc:
+            if exc.errno not in _FALLBACK_ERRNOS:
+                raise
+
+    buffer = getattr(_thread_local, "buffer", None)
+    if buffer is None:
+        buffer = _thread_local.buffer = memoryview(bytearray(_COPY_BUFSIZE))
+    with open(src_fd, "rb", buffering=0, closefd=False) as src:
+        while n := src.readinto(buffer):
+            view = buffer[:n]
+            while view:
+                view = view[os.write(dst_fd, view) :]
+
+
 __all__ = [
     "CopyImageConfig",
     "CopyImageStats",
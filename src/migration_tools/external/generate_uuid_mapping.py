@@ -18,11 +18,28 @@ generate_uuid_mapping.py
 """
 import argparse
 import os
+from concurrent.futures import ProcessPoolExecutor
 from typing import Dict, List, Tuple
 
 import numpy as np
 from PIL import Image
 
+# (hashes, hists): uint64 dHash 向量 (N,) 与 float32 直方图矩阵 (N, 3 * bins)，行顺序与 uuid 列表一致
+Metrics = Tuple[np.ndarray, np.ndarray]
+
+# popcount lookup table for one byte
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+# cells per block when computing the pairwise distance matrix
+_BLOCK_CELLS = 1 << 22
+# below this many images the process pool startup costs more than it saves
+_PARALLEL_MIN_IMAGES = 64
+# images are shrunk to roughly this size before hashing / histogramming
+_METRICS_SIZE = 64
+# modes Image.reduce() accepts without a prior convert
+_REDUCIBLE_MODES = frozenset({"RGB", "RGBA", "L", "LA"})
+# narrowest hash segment worth bucketing on; below this a bucket holds too much of B
+_MIN_SEGMENT_BITS = 8
+
 
 def read_list(path: str) -> List[str]:
     with open(path, "r", encoding="utf-8") as f:
@@ -42,25 +59,110 @@ def dhash(image: Image.Image, hash_size: int = 8) -> int:
     """Compute difference hash (dHash) for an image, return as int (hash_size*hash_size bits).
     Reference: https://www.hackerfactor.com/blog/index.php?/archives/529-Kind-of-Like-That.html
     """
+    # the packed bits below fill whole bytes only when hash_size is a multiple of 8
+    if hash_size <= 0 or hash_size % 8:
+        raise ValueError(f"hash_size must be a positive multiple of 8, got {hash_size}")
     # convert to grayscale and resize (hash_size+1, hash_size)
+    # BILINEAR is plenty for a 9x8 thumbnail; dHash itself tolerates crude downsampling
     image = image.convert("L").resize(
-        (hash_size + 1, hash_size), Image.Resampling.LANCZOS
+        (hash_size + 1, hash_size), Image.Resampling.BILINEAR
     )
     arr = np.asarray(image, dtype=np.uint8)
     # compute differences between adjacent columns
     diff = arr[:, 1:] > arr[:, :-1]
-    # pack into integer
-    bit_array = diff.flatten()
-    h = 0
-    for b in bit_array:
-        h = (h << 1) | int(b)
-    return h
+    # pack into integer (MSB first)
+    packed = np.packbits(diff.ravel())
+    return int.from_bytes(packed.tobytes(), "big")
 
 
 def hamming_distance(a: int, b: int) -> int:
     return (a ^ b).bit_count()
 
 
+def popcount64(x: np.ndarray) -> np.ndarray:
+    """Number of set bits of every element of a uint64 array, as uint8."""
+    bits = _POPCOUNT8[x.view(np.uint8)].reshape(*x.shape, 8)
+    return bits.sum(axis=-1, dtype=np.uint8)
+
+
+def hamming_matrix(a_hashes: np.ndarray, b_hashes: np.ndarray) -> np.ndarray:
+    """Pairwise Hamming distances between two uint64 hash vectors, shape (len(a), len(b))."""
+    return popcount64(np.bitwise_xor.outer(a_hashes, b_hashes))
+
+
+def _hash_segments(max_hamming: int) -> List[Tuple[int, int]]:
+    """Split 64 bits into max_hamming + 1 (shift, width) segments.
+
+    Two hashes within max_hamming bits must agree on at least one segment (pigeonhole).
+    """
+    count = max_hamming + 1
+    width, extra = divmod(64, count)
+    segments = []
+    shift = 0
+    for k in range(count):
+        w = width + (1 if k < extra else 0)
+        segments.append((shift, w))
+        shift += w
+    return segments
+
+
+def candidate_pairs(
+    a_hashes: np.ndarray, b_hashes: np.ndarray, max_hamming: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """All (dist, a_idx, b_idx) with dist <= max_hamming, in row-major (a, b) order."""
+    cand_d, cand_a, cand_b = [], [], []
+    nb = len(b_hashes)
+    step = max(1, _BLOCK_CELLS // max(1, nb))
+
+    if 0 <= max_hamming < 64 and 64 // (max_hamming + 1) >= _MIN_SEGMENT_BITS:
+        # bucket B by every segment once; each A then only probes the B entries
+        # sharing one of its segments instead of the whole of B
+        buckets = []
+        for shift, width in _hash_segments(max_hamming):
+            sh, mask = np.uint64(shift), np.uint64((1 << width) - 1)
+            keys = (b_hashes >> sh) & mask
+            order = np.argsort(keys, kind="stable")
+            buckets.append((sh, mask, keys[order], order))
+
+        for start in range(0, len(a_hashes), step):
+            block = a_hashes[start : start + step]
+            flat = []
+            for sh, mask, sorted_keys, order in buckets:
+                keys = (block >> sh) & mask
+                lo = np.searchsorted(sorted_keys, keys, side="left")
+                counts = np.searchsorted(sorted_keys, keys, side="right") - lo
+                total = int(counts.sum())
+                if not total:
+                    continue
+                ai = np.repeat(np.arange(len(block), dtype=np.int64), counts)
+                firsts = np.repeat(np.cumsum(counts) - counts, counts)
+                bi = order[np.repeat(lo, counts) + np.arange(total) - firsts]
+                flat.append(ai * nb + bi)
+            if not flat:
+                continue
+            # np.unique drops pairs found via several segments and restores (a, b) order
+            flat = np.unique(np.concatenate(flat))
+            ai, bi = flat // nb, flat % nb
+            dist = popcount64(block[ai] ^ b_hashes[bi])
+            keep = dist <= max_hamming
+            cand_d.append(dist[keep])
+            cand_a.append(ai[keep] + start)
+            cand_b.append(bi[keep])
+    else:
+        # segments would be too narrow to prune anything, scan the full matrix
+        for start in range(0, len(a_hashes), step):
+            dist = hamming_matrix(a_hashes[start : start + step], b_hashes)
+            ai, bi = np.nonzero(dist <= max_hamming)
+            cand_d.append(dist[ai, bi])
+            cand_a.append(ai + start)
+            cand_b.append(bi)
+
+    if not cand_d:
+        empty = np.empty(0, dtype=np.int64)
+        return np.empty(0, dtype=np.uint8), empty, empty
+    return np.concatenate(cand_d), np.concatenate(cand_a), np.concatenate(cand_b)
+
+
 def color_histogram(image: Image.Image, bins_per_channel: int = 8) -> np.ndarray:
     """Compute normalized RGB histogram (flattened).
     Return L1-normalized 1D array.
@@ -68,89 +170,106 @@ def color_histogram(image: Image.Image, bins_per_channel: int = 8) -> np.ndarray
     # ensure RGB
     im = image.convert("RGB")
     arr = np.asarray(im)
-    # compute histogram per channel
-    hist = []
-    for ch in range(3):
-        h, _ = np.histogram(arr[..., ch], bins=bins_per_channel, range=(0, 256))
-        hist.append(h)
-    hist = np.concatenate(hist).astype(np.float32)
+    # bin index of each value: floor(v * bins / 256), i.e. v >> 5 for 8 bins,
+    # offset per channel so a single bincount yields the concatenated R|G|B histogram
+    idx = (arr.astype(np.uint16) * bins_per_channel) >> 8
+    idx += np.arange(3, dtype=np.uint16) * bins_per_channel
+    hist = np.bincount(idx.ravel(), minlength=3 * bins_per_channel).astype(np.float32)
     s = hist.sum()
     if s > 0:
         hist /= s
     return hist
 
 
-def load_image_metrics(path: str) -> Tuple[int, np.ndarray]:
+def load_image_metrics(item: Tuple[str, str]) -> Tuple[str, int, np.ndarray]:
+    u, path = item
     with Image.open(path) as im:
-        dh = dhash(im)
-        ch = color_histogram(im)
-    return dh, ch
-
-
-def build_metrics_map(
-    dir_path: str, uuids: List[str], ext: str = ".webp"
-) -> Dict[str, Tuple[int, np.ndarray]]:
-    m = {}
+        # let decoders that support it (JPEG) decode at a reduced scale directly
+        im.draft("RGB", (_METRICS_SIZE, _METRICS_SIZE))
+        # reduce() only handles 8-bit modes; palette / 1-bit / 16-bit images are
+        # converted first, as the metrics below would convert them anyway
+        if im.mode not in _REDUCIBLE_MODES:
+            im = im.convert("RGB")
+        # cheap box downsample before the final resize, both metrics use the small copy
+        factor = min(im.width, im.height) // _METRICS_SIZE
+        small = im.reduce(factor) if factor > 1 else im
+        dh = dhash(small)
+        ch = color_histogram(small)
+    return u, dh, ch
+
+
+def build_metrics_map(dir_path: str, uuids: List[str], ext: str = ".webp") -> Metrics:
+    items = []
     for u in uuids:
         p = os.path.join(dir_path, u + ext)
         if not os.path.exists(p):
             raise FileNotFoundError(f"Image not found: {p}")
-        m[u] = load_image_metrics(p)
-    return m
+        items.append((u, p))
+
+    # decoding + resizing is CPU-bound, so spread it over all cores
+    if len(items) < _PARALLEL_MIN_IMAGES:
+        results = list(map(load_image_metrics, items))
+    else:
+        with ProcessPoolExecutor() as ex:
+            results = list(ex.map(load_image_metrics, items, chunksize=32))
+
+    hashes = np.array([dh for _, dh, _ in results], dtype=np.uint64)
+    if not results:
+        return hashes, np.empty((0, 0), dtype=np.float32)
+    return hashes, np.stack([ch for _, _, ch in results])
 
 
 def greedy_match(
     a_keys: List[str],
     b_keys: List[str],
-    a_metrics: Dict[str, Tuple[int, np.ndarray]],
-    b_metrics: Dict[str, Tuple[int, np.ndarray]],
+    a_metrics: Metrics,
+    b_metrics: Metrics,
     max_hamming: int = 10,
     hist_threshold: float = 0.35,
 ) -> Dict[str, str]:
-    # build all pairwise hamming distances
-    pairs = []  # (dist, a, b)
-    for a in a_keys:
-        ah, _ = a_metrics[a]
-        for b in b_keys:
-            bh, _ = b_metrics[b]
-            d = hamming_distance(ah, bh)
-            pairs.append((d, a, b))
-    pairs.sort(key=lambda x: x[0])
+    a_hashes, a_hists = a_metrics
+    b_hashes, b_hists = b_metrics
+
+    # pairs above the threshold can never be assigned by the first pass
+    cand_d, cand_a, cand_b = candidate_pairs(a_hashes, b_hashes, max_hamming)
 
     assigned_a = set()
     assigned_b = set()
     mapping = {}
 
     # first pass: assign by small hamming distances
-    for d, a, b in pairs:
+    # (stable sort keeps ties in A-then-B order, as the nested pair loop did)
+    order = np.argsort(cand_d, kind="stable")
+    for i, j in zip(cand_a[order].tolist(), cand_b[order].tolist()):
+        a, b = a_keys[i], b_keys[j]
         if a in assigned_a or b in assigned_b:
             continue
-        if d <= max_hamming:
-            mapping[a] = b
-            assigned_a.add(a)
-            assigned_b.add(b)
+        mapping[a] = b
+        assigned_a.add(a)
+        assigned_b.add(b)
 
     # second pass: for unassigned a, try histogram fallback
-    remaining_a = [a for a in a_keys if a not in assigned_a]
-    remaining_b = [b for b in b_keys if b not in assigned_b]
-    if remaining_a and remaining_b:
-        # precompute hist vectors
-        for a in remaining_a:
-            ah, a_hist = a_metrics[a]
-            best_b = None
-            best_score = float("inf")
-            for b in remaining_b:
-                bh, b_hist = b_metrics[b]
-                # L1 distance between normalized histograms
-                score = float(np.sum(np.abs(a_hist - b_hist)))
-                if score < best_score:
-                    best_score = score
-                    best_b = b
-            if best_b is not None and best_score <= hist_threshold:
-                mapping[a] = best_b
-                assigned_a.add(a)
-                assigned_b.add(best_b)
-                remaining_b.remove(best_b)
+    rem_a = [i for i, a in enumerate(a_keys) if a not in assigned_a]
+    rem_b = np.array(
+        [j for j, b in enumerate(b_keys) if b not in assigned_b], dtype=np.int64
+    )
+    if rem_a and len(rem_b):
+        b_mat = b_hists[rem_b]
+        taken = np.zeros(len(rem_b), dtype=bool)
+        step = max(1, _BLOCK_CELLS // (len(rem_b) * b_mat.shape[1]))
+        for start in range(0, len(rem_a), step):
+            block = rem_a[start : start + step]
+            # L1 distance between normalized histograms, one row per remaining a
+            dist = np.abs(a_hists[block][:, None, :] - b_mat[None, :, :]).sum(axis=-1)
+            for i, row in zip(block, dist):
+                if taken.all():
+                    return mapping
+                # b already taken by an earlier a are out; argmin keeps the first best b
+                row[taken] = np.inf
+                k = int(np.argmin(row))
+                if row[k] <= hist_threshold:
+                    mapping[a_keys[i]] = b_keys[rem_b[k]]
+                    taken[k] = True
 
     return mapping
 
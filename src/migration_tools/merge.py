@@ -4,21 +4,29 @@ import logging
 import uuid
 from dataclasses import dataclass
 from datetime import datetime, timezone
+from functools import lru_cache
 from typing import List, Sequence
 
-from sqlalchemy import create_engine, text
+from sqlalchemy import bindparam, create_engine, text
 from sqlalchemy.engine import Connection, Engine, Row
 
+from .bulk import StagedUpsert, driver_connect_args
 from .transform import (
     MergeSectionResult,
     UnknownAspectError,
     build_image_labels,
     build_image_name,
     derive_aspect_id,
+    uuid4_stream,
 )
 
 logger = logging.getLogger(__name__)
 
+_YIELD_PER = 10_000
+
+# _ensure_datetime 逐行调用，直接引用模块级的 UTC 对象
+_UTC = timezone.utc
+
 
 @dataclass(slots=True)
 class MergeConfig:
@@ -26,9 +34,11 @@ class MergeConfig:
 
     source_url: str
     target_url: str
-    batch_size: int = 500
+    batch_size: int = 5000
     dry_run: bool = False
     admin_user_id: str | None = None
+    # 迁移只使用两个长连接，默认不在取连接时发 ping 探活
+    pool_pre_ping: bool = False
 
 
 @dataclass(slots=True)
@@ -41,8 +51,8 @@ class MergeResult:
 
 def run_merge(config: MergeConfig) -> MergeResult:
     """入口：建立连接并执行用户、图片的迁移。"""
-    source_engine = _create_engine(config.source_url, name="source")
-    target_engine = _create_engine(config.target_url, name="target")
+    source_engine = _create_engine(config.source_url, name="source", config=config)
+    target_engine = _create_engine(config.target_url, name="target", config=config)
 
     try:
         with (
@@ -51,18 +61,22 @@ def run_merge(config: MergeConfig) -> MergeResult:
         ):
             source_tx = source_conn.begin()
             target_tx = target_conn.begin()
+            # 整次运行共用一个“当前时间”，用于补齐缺失的时间戳与写入 updated_at
+            now = _utcnow()
             try:
                 logger.info("开始迁移 users 与 images 表数据")
                 users_summary = merge_users(
                     source_conn=source_conn,
                     target_conn=target_conn,
                     batch_size=config.batch_size,
+                    now=now,
                 )
                 images_summary = merge_images(
                     source_conn=source_conn,
                     target_conn=target_conn,
                     batch_size=config.batch_size,
                     admin_user_id=config.admin_user_id,
+                    now=now,
                 )
             except Exception:
                 logger.exception("迁移过程中发生错误，正在回滚")
@@ -89,35 +103,38 @@ def run_merge(config: MergeConfig) -> MergeResult:
 # users
 # ---------------------------------------------------------------------------
 
+# 迁移用到的查询语句均为静态 SQL，在模块加载时构造一次
+_SELECT_SOURCE_USERS = text(
+    "SELECT id, username, hashed_password, email, created_at FROM users ORDER BY id"
+)
+
 
 def merge_users(
-    *, source_conn: Connection, target_conn: Connection, batch_size: int
+    *,
+    source_conn: Connection,
+    target_conn: Connection,
+    batch_size: int,
+    now: datetime | None = None,
 ) -> MergeSectionResult:
     summary = MergeSectionResult()
-    existing_ids = _collect_existing_ids(target_conn, "tbl_user")
 
-    stmt = text(
-        "SELECT id, username, hashed_password, email, created_at FROM users ORDER BY id"
-    )
-    rows = source_conn.execute(stmt)
+    rows = source_conn.execute(_SELECT_SOURCE_USERS)
 
+    # 本次迁移共用同一个 updated_at；新 id 从批量生成的随机 uuid 流中获取
+    if now is None:
+        now = _utcnow()
+    new_ids = uuid4_stream(batch_size)
     payload: List[dict] = []
     for row in rows:
         summary.processed += 1
-        entry = _adapt_user_row(row)
-        if row.id in existing_ids:
-            summary.updated += 1
-        else:
-            summary.inserted += 1
-            existing_ids.add(row.id)
-        payload.append(entry)
+        payload.append(_adapt_user_row(row, now, next(new_ids)))
 
         if len(payload) >= batch_size:
-            _upsert_users(target_conn, payload)
+            _upsert_users(target_conn, payload, summary)
             payload.clear()
 
     if payload:
-        _upsert_users(target_conn, payload)
+        _upsert_users(target_conn, payload, summary)
 
     logger.info(
         "用户迁移完成：共处理 %s 条，新增 %s 条，更新 %s 条，跳过 %s 条",
@@ -129,30 +146,62 @@ def merge_users(
     return summary
 
 
-def _adapt_user_row(row: Row) -> dict:
-    created_at = _ensure_datetime(row.created_at)
-    now = datetime.utcnow()
+def _adapt_user_row(row: Row, now: datetime, new_id: uuid.UUID) -> dict:
+    created_at = _ensure_datetime(row.created_at, now=now)
     return {
-        "id": uuid.uuid4(),
+        "id": new_id,
         "username": row.username,
         "hashed_password": row.hashed_password,
         "email": row.email,
+        "permissions": "{}",
         "created_at": created_at,
         "updated_at": now,
     }
 
 
-def _upsert_users(conn: Connection, payload: Sequence[dict]) -> None:
-    if not payload:
-        return
+_USER_COLUMNS = (
+    "id",
+    "username",
+    "hashed_password",
+    "email",
+    "permissions",
+    "created_at",
+    "updated_at",
+)
+# 新增/更新数由合并语句的 RETURNING 统计，无需预先扫描整张 tbl_user
+_USER_UPSERT = StagedUpsert(
+    "tbl_user",
+    _USER_COLUMNS,
+    conflict=("id",),
+    update=("username", "hashed_password", "email", "updated_at"),
+)
+# 每个批次都会执行，语句在模块加载时构造一次
+_SELECT_USERS_BY_NAME = text(
+    "SELECT username, id FROM tbl_user WHERE username IN :names"
+).bindparams(bindparam("names", expanding=True))
+
+
+def _upsert_users(
+    conn: Connection, payload: Sequence[dict], summary: MergeSectionResult
+) -> None:
     if not payload:
         return
 
     # Filter out rows where the username is already taken by a different id.
-    existing = {
-        str(row.username): str(row.id)
-        for row in conn.execute(text("SELECT username, id FROM tbl_user"))
-    }
+    # Only the usernames of this batch are looked up, not the whole table.
+    names = sorted(
+        {
+            str(entry["username"])
+            for entry in payload
+            if entry.get("username") is not None
+        }
+    )
+    existing = {}
+    if names:
+        existing = {
+            str(row.username): str(row.id)
+            for row in conn.execute(_SELECT_USERS_BY_NAME, {"names": names})
+        }
 
     filtered: List[dict] = []
     for entry in payload:
@@ -165,32 +214,39 @@ def _upsert_users(conn: Connection, payload: Sequence[dict]) -> None:
             logger.warning(
                 "跳过用户 %s：用户名已被不同用户 %s 占用", uname, existing_id
             )
+            summary.skipped += 1
             continue
         filtered.append(entry)
 
     if not filtered:
         return
 
-    conn.execute(
-        text(
-            """
-            INSERT INTO tbl_user (id, username, hashed_password, email, permissions, created_at, updated_at)
-            VALUES (:id, :username, :hashed_password, :email, '{}', :created_at, :updated_at)
-            ON CONFLICT (id) DO UPDATE SET
-                username = EXCLUDED.username,
-                hashed_password = EXCLUDED.hashed_password,
-                email = EXCLUDED.email,
-                updated_at = EXCLUDED.updated_at
-            """
-        ),
-        filtered,
+    inserted = _USER_UPSERT.execute(
+        conn, ([entry[column] for column in _USER_COLUMNS] for entry in filtered)
     )
+    summary.inserted += inserted
+    summary.updated += len(filtered) - inserted
 
 
 # ---------------------------------------------------------------------------
 # images
 # ---------------------------------------------------------------------------
 
+# merge_images 只执行一次的查询，同样提前构造好
+_SELECT_SOURCE_USER_NAMES = text("SELECT id, username FROM users").execution_options(
+    stream_results=True, yield_per=_YIELD_PER
+)
+_SELECT_TARGET_USER_IDS = text("SELECT username, id FROM tbl_user").execution_options(
+    stream_results=True, yield_per=_YIELD_PER
+)
+_SELECT_SOURCE_IMAGES = text(
+    """
+    SELECT uuid, kind, label, file_name, uploaded_by, uploaded_at, category, trace_id
+    FROM images
+    ORDER BY uploaded_at, uuid
+    """
+).execution_options(stream_results=True, yield_per=_YIELD_PER)
+
 
 def merge_images(
     *,
@@ -198,72 +254,96 @@ def merge_images(
     target_conn: Connection,
     batch_size: int,
     admin_user_id: str | None = None,
+    now: datetime | None = None,
 ) -> MergeSectionResult:
     summary = MergeSectionResult()
     ensure_required_aspects(target_conn)
 
     # 构造用于将源库的用户 id 映射到目标库的用户 id 的映射。
     # 源库 users 表保留了 username；目标库 tbl_user 使用 username 唯一匹配并可能有新的 id。
+    # 大表查询均使用服务端游标分批读取，避免客户端一次性缓冲全部结果。
     source_id_to_username = {
         str(row.id): row.username
-        for row in source_conn.execute(text("SELECT id, username FROM users"))
+        for row in source_conn.execute(_SELECT_SOURCE_USER_NAMES)
     }
 
+    # 目标库 id 统一为 uuid.UUID，写入 tbl_image 时无需先转成字符串
     target_username_to_id = {
-        str(row.username): str(row.id)
-        for row in target_conn.execute(text("SELECT username, id FROM tbl_user"))
+        str(row.username): _as_uuid(row.id)
+        for row in target_conn.execute(_SELECT_TARGET_USER_IDS)
     }
 
-    existing_uuids = _collect_existing_ids(target_conn, "tbl_image", column="id")
+    # 合并两步查找：源用户 id 直接映射到目标用户 id；
+    # 用户名在目标库缺失的源用户单独记录，仅用于输出跳过原因。
+    source_to_target_id = {}
+    unmatched_usernames = {}
+    for src_uid, username in source_id_to_username.items():
+        tgt_user_id = target_username_to_id.get(username)
+        if tgt_user_id is None:
+            unmatched_usernames[src_uid] = username
+        else:
+            source_to_target_id[src_uid] = tgt_user_id
+
+    # 新增/更新数由合并语句的 RETURNING 统计，无需预先扫描整张 tbl_image
     known_user_ids = set(target_username_to_id.values())
 
-    if admin_user_id is not None and admin_user_id not in known_user_ids:
-        raise ValueError(f"admin-user-id {admin_user_id} 不存在于目标库的 tbl_user 中")
+    admin_id = None
+    if admin_user_id is not None:
+        try:
+            admin_id = uuid.UUID(admin_user_id)
+        except ValueError:
+            raise ValueError(f"admin-user-id {admin_user_id} 不是合法的 UUID") from None
+        if admin_id not in known_user_ids:
+            raise ValueError(
+                f"admin-user-id {admin_user_id} 不存在于目标库的 tbl_user 中"
+            )
 
-    stmt = text(
-        """
-        SELECT uuid, kind, label, file_name, uploaded_by, uploaded_at, category, trace_id
-        FROM images
-        ORDER BY uploaded_at, uuid
-        """
-    )
-    rows = source_conn.execute(stmt)
+    rows = source_conn.execute(_SELECT_SOURCE_IMAGES)
 
+    if now is None:
+        now = _utcnow()
+    # 上传者无法映射的图片按原因计数，结束时汇总输出一次；
+    # 逐行的调试日志只在开启 DEBUG 时输出
+    debug = logger.isEnabledFor(logging.DEBUG)
+    missing_source_users = 0
+    missing_target_users = 0
     payload: List[dict] = []
     for row in rows:
         summary.processed += 1
 
         if row.uploaded_by is None:
-            if admin_user_id is None:
+            if admin_id is None:
                 summary.skipped += 1
                 logger.warning(
                     "图片 %s 无上传用户且未提供 admin-user-id，已跳过", row.uuid
                 )
                 continue
-            user_id = admin_user_id
+            user_id = admin_id
             visibility = 1
         else:
-            # uploaded_by 在源库是源用户 id；目标库的用户 id 可能已改变。
-            # 通过源库的 id->username 映射，再用 username 在目标库查找对应 id。
+            # uploaded_by 在源库是源用户 id；目标库的用户 id 可能已改变，
+            # 经预先合并的 源 id -> 目标 id 映射一次查得。
             src_uid = str(row.uploaded_by)
-            username = source_id_to_username.get(src_uid)
-            if username is None:
-                summary.skipped += 1
-                logger.warning(
-                    "图片 %s 的上传者 %s 在源库 users 表中不存在，已跳过",
-                    row.uuid,
-                    row.uploaded_by,
-                )
-                continue
-
-            tgt_user_id = target_username_to_id.get(username)
+            tgt_user_id = source_to_target_id.get(src_uid)
             if tgt_user_id is None:
                 summary.skipped += 1
-                logger.warning(
-                    "图片 %s 的上传者用户名 %s 在目标库 tbl_user 中不存在，已跳过",
-                    row.uuid,
-                    username,
-                )
+                username = unmatched_usernames.get(src_uid)
+                if username is None:
+                    missing_source_users += 1
+                    if debug:
+                        logger.debug(
+                            "图片 %s 的上传者 %s 在源库 users 表中不存在，已跳过",
+                            row.uuid,
+                            row.uploaded_by,
+                        )
+                else:
+                    missing_target_users += 1
+                    if debug:
+                        logger.debug(
+                            "图片 %s 的上传者用户名 %s 在目标库 tbl_user 中不存在，已跳过",
+                            row.uuid,
+                            username,
+                        )
                 continue
 
             user_id = tgt_user_id
@@ -277,22 +357,25 @@ def merge_images(
             continue
 
         entry = _adapt_image_row(
-            row, aspect_id, user_id, visibility, row.uploaded_by is not None
+            row, aspect_id, user_id, visibility, row.uploaded_by is not None, now
         )
-
-        if row.uuid in existing_uuids:
-            summary.updated += 1
-        else:
-            summary.inserted += 1
-            existing_uuids.add(row.uuid)
-
         payload.append(entry)
         if len(payload) >= batch_size:
-            _upsert_images(target_conn, payload)
+            _upsert_images(target_conn, payload, summary)
             payload.clear()
 
     if payload:
-        _upsert_images(target_conn, payload)
+        _upsert_images(target_conn, payload, summary)
+
+    if missing_source_users:
+        logger.warning(
+            "%s 张图片的上传者在源库 users 表中不存在，已跳过", missing_source_users
+        )
+    if missing_target_users:
+        logger.warning(
+            "%s 张图片的上传者用户名在目标库 tbl_user 中不存在，已跳过",
+            missing_target_users,
+        )
 
     logger.info(
         "图片迁移完成：共处理 %s 条，新增 %s 条，更新 %s 条，跳过 %s 条",
@@ -304,6 +387,15 @@ def merge_images(
     return summary
 
 
+_INSERT_IMAGE_ASPECTS = text(
+    """
+    INSERT INTO tbl_image_aspect (id, name, description, ratio_width_unit, ratio_height_unit)
+    VALUES (:id, :name, :description, :ratio_width_unit, :ratio_height_unit)
+    ON CONFLICT (id) DO NOTHING
+    """
+)
+
+
 def ensure_required_aspects(target_conn: Connection) -> None:
     required = {
         "id-1-ff": {
@@ -315,41 +407,25 @@ def ensure_required_aspects(target_conn: Connection) -> None:
         }
     }
 
-    existing = {
-        row.id
-        for row in target_conn.execute(
-            text("SELECT id FROM tbl_image_aspect WHERE id IN (:bg)"),
-            {"bg": "id-1-ff"},
-        )
-    }
-
-    missing = [data for key, data in required.items() if key not in existing]
-    if not missing:
-        return
-
-    target_conn.execute(
-        text(
-            """
-            INSERT INTO tbl_image_aspect (id, name, description, ratio_width_unit, ratio_height_unit)
-            VALUES (:id, :name, :description, :ratio_width_unit, :ratio_height_unit)
-            ON CONFLICT (id) DO NOTHING
-            """
-        ),
-        missing,
-    )
-    logger.info(
-        "已补充缺失的图片比例配置：%s", ", ".join(item["id"] for item in missing)
-    )
+    # ON CONFLICT DO NOTHING 已保证幂等，无需先查询是否存在。
+    target_conn.execute(_INSERT_IMAGE_ASPECTS, list(required.values()))
+    logger.info("已确保必需的图片比例配置存在：%s", ", ".join(required))
 
 
 def _adapt_image_row(
-    row: Row, aspect_id: str, user_id: str, visibility: int, workshop: bool
+    row: Row,
+    aspect_id: str,
+    user_id: uuid.UUID,
+    visibility: int,
+    workshop: bool,
+    now: datetime,
 ) -> dict:
-    uploaded_at = _ensure_datetime(row.uploaded_at)
+    uploaded_at = _ensure_datetime(row.uploaded_at, now=now)
     labels = build_image_labels(row.kind, row.category, workshop)
 
     return {
-        "id": row.uuid,
+        # 源库的 uuid 是文本列，写入目标库前转成 uuid.UUID
+        "id": uuid.UUID(row.uuid),
         "uuid": row.uuid,
         "user_id": user_id,
         "aspect_id": aspect_id,
@@ -360,57 +436,46 @@ def _adapt_image_row(
         "original_name": row.file_name,
         "original_id": row.trace_id,
         "created_at": uploaded_at,
-        "updated_at": datetime.utcnow(),
+        "updated_at": now,
     }
 
 
-def _upsert_images(conn: Connection, payload: Sequence[dict]) -> None:
+_IMAGE_COLUMNS = (
+    "id",
+    "user_id",
+    "aspect_id",
+    "name",
+    "description",
+    "visibility",
+    "labels",
+    "original_name",
+    "original_id",
+    "created_at",
+    "updated_at",
+)
+
+
+# 语句只构造一次；psycopg 下经 COPY 写入暂存表，其他驱动由 StagedUpsert 回退为 executemany
+_IMAGE_UPSERT = StagedUpsert(
+    "tbl_image",
+    _IMAGE_COLUMNS,
+    conflict=("id",),
+    update=tuple(c for c in _IMAGE_COLUMNS if c != "created_at"),
+    binary=True,
+)
+
+
+def _upsert_images(
+    conn: Connection, payload: Sequence[dict], summary: MergeSectionResult
+) -> None:
     if not payload:
         return
-    conn.execute(
-        text(
-            """
-            INSERT INTO tbl_image (
-                id,
-                user_id,
-                aspect_id,
-                name,
-                description,
-                visibility,
-                labels,
-                original_name,
-                original_id,
-                created_at,
-                updated_at
-            )
-            VALUES (
-                :id,
-                :user_id,
-                :aspect_id,
-                :name,
-                :description,
-                :visibility,
-                :labels,
-                :original_name,
-                :original_id,
-                :created_at,
-                :updated_at
-            )
-            ON CONFLICT (id) DO UPDATE SET
-                id = EXCLUDED.id,
-                user_id = EXCLUDED.user_id,
-                aspect_id = EXCLUDED.aspect_id,
-                name = EXCLUDED.name,
-                description = EXCLUDED.description,
-                visibility = EXCLUDED.visibility,
-                labels = EXCLUDED.labels,
-                original_name = EXCLUDED.original_name,
-                original_id = EXCLUDED.original_id,
-                updated_at = EXCLUDED.updated_at
-            """
-        ),
-        payload,
+    inserted = _IMAGE_UPSERT.execute(
+        conn, ([entry[column] for column in _IMAGE_COLUMNS] for entry in payload)
     )
+    # 批次内重复的 id 只写入一行，其余按更新计数
+    summary.inserted += inserted
+    summary.updated += len(payload) - inserted
 
 
 # ---------------------------------------------------------------------------
@@ -418,23 +483,48 @@ def _upsert_images(conn: Connection, payload: Sequence[dict]) -> None:
 # ---------------------------------------------------------------------------
 
 
-def _create_engine(url: str, *, name: str) -> Engine:
-    engine = create_engine(url, pool_pre_ping=True, future=True)
-    logger.debug("已创建 %s 数据库引擎: %s", name, url)
+def _create_engine(url: str, *, name: str, config: MergeConfig) -> Engine:
+    engine = _engine_for(url, config.batch_size, config.pool_pre_ping)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("使用 %s 数据库引擎: %s", name, url)
     return engine
 
 
-def _collect_existing_ids(conn: Connection, table: str, column: str = "id") -> set:
-    result = conn.execute(text(f"SELECT {column} FROM {table}"))
-    return {str(row[0]) for row in result}
+@lru_cache(maxsize=8)
+def _engine_for(url: str, batch_size: int, pool_pre_ping: bool) -> Engine:
+    # 同一进程内重复迁移时按 URL 复用引擎；运行结束的 dispose() 只关闭连接池。
+    # 与 merge-up 一致：executemany 由 psycopg 3 以 pipeline 批量发送，
+    # Core insert 的 insertmanyvalues 分页与迁移批次大小保持一致。
+    return create_engine(
+        url,
+        pool_pre_ping=pool_pre_ping,
+        insertmanyvalues_page_size=batch_size,
+        connect_args=driver_connect_args(url),
+    )
+
+
+def _as_uuid(value) -> uuid.UUID:
+    # psycopg 对 uuid 列直接返回 uuid.UUID；文本列或其他驱动返回字符串时再解析
+    return value if isinstance(value, uuid.UUID) else uuid.UUID(str(value))
+
+
+def _utcnow() -> datetime:
+    # 目标库的时间列均为不带时区的 UTC 时间
+    return datetime.now(_UTC).replace(tzinfo=None)
 
 
-def _ensure_datetime(value: datetime | None) -> datetime:
+def _ensure_datetime(
+    value: datetime | None, *, now: datetime | None = None
+) -> datetime:
     if value is None:
-        return datetime.utcnow()
-    if value.tzinfo:
-        return value.astimezone(timezone.utc).replace(tzinfo=None)
-    return value
+        return now if now is not None else _utcnow()
+    tz = value.tzinfo
+    if tz is None:
+        return value
+    if tz is _UTC:
+        # 已是 UTC，直接去掉时区即可，无需 astimezone 换算
+        return value.replace(tzinfo=None)
+    return value.astimezone(_UTC).replace(tzinfo=None)
 
 
 __all__ = [
@@ -1,16 +1,25 @@
 from __future__ import annotations
 
 import logging
+import os
 import secrets
+import threading
 import uuid
-from collections import defaultdict
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass
 from datetime import datetime, timezone
-from typing import Dict, Iterator, List, Mapping, Sequence
+from functools import lru_cache
+from itertools import chain, groupby, islice, repeat
+from operator import attrgetter, itemgetter
+from queue import Empty, Queue
+from types import MappingProxyType
+from typing import Dict, Iterable, Iterator, List, Mapping, Sequence, TypeVar
 
-from sqlalchemy import create_engine, text
-from sqlalchemy.engine import Connection, Engine
+from sqlalchemy import bindparam, create_engine, text
+from sqlalchemy.engine import Connection, Engine, Row
 
+from .bulk import StagedUpsert, driver_connect_args
 from .merge import ensure_required_aspects
 from .transform import (
     MergeSectionResult,
@@ -18,56 +27,65 @@ from .transform import (
     build_image_labels,
     build_image_name,
     derive_aspect_id,
+    uuid4_stream,
 )
 
 logger = logging.getLogger(__name__)
 
+_T = TypeVar("_T")
+
+# 模块加载时绑定 UTC 时区对象，时间规范化的热路径只做一次全局查找
+_UTC = timezone.utc
+
 # wtf i have no idea to map these properly so hardcode for now
-uuid_mapping = {
-    "1051f05f-d605-4b73-93b8-66c6e32c4979": "bce7437d-0243-4b03-8ee4-90cf069fb403",
-    "1a0bbc52-a927-45ef-b81d-a14c0442b563": "dce699fc-6878-43d6-b7fc-ce2d2d5afb40",
-    "1c30bd9d-a0be-434f-96a3-31a34291ebc6": "deff9fde-4542-4dad-aa60-15b8848b2513",
-    "1ed53623-0107-4b20-bd6b-699b27ad5b09": "84adfa36-69b7-491e-8faf-ecfeca08ba2c",
-    "268a5b81-1e53-42aa-aaf0-4d17936d7116": "039f9d39-4bc1-4569-b4c1-ae5b7c6483c1",
-    "2e0265e4-89b5-4977-86d4-96f961960561": "fcab9c9c-0be7-4d14-9172-72f10ee4282e",
-    "3f9e16ad-cd47-4910-a4e5-d8c222976791": "cad4cc4f-0073-42e8-8596-bd22a7f5193d",
-    "4091f5b5-f08e-45f3-ab0b-53249f3609e2": "f56964ac-6940-40b0-bb31-bd60afa064d2",
-    "596a0a0e-721a-4fc4-a49b-b54f612d75e5": "1d4628b8-c1e8-4c8c-9d75-c6cb08cead0c",
-    "77e8169b-e48f-43f0-b4ed-e9fd3c87805b": "23164b47-1cd4-4c39-b895-488eba89b8ab",
-    "7d25b953-39b3-41a3-aec3-3cfa5e2d7adb": "b916c283-7003-4bec-b1d1-950ecb5b79ff",
-    "888794e2-8d8a-4838-9d0f-d3e8d06d9b30": "3b57ce3f-e2d4-4165-844c-0d0d39fbbab2",
-    "8eb3efbf-b199-48b3-aa08-fd427ac91cc9": "7e30dae1-d1f8-47bd-a6ff-56ac5983e6e2",
-    "944d9a96-2774-4f4a-a9f9-422fb5f5f1a6": "ce79feda-4f5e-47fc-95bc-23f1e293570b",
-    "adb6b3e9-b7f5-4724-946a-ef35be51603e": "6a742fd3-f9e2-4edf-ab65-9208fae30d36",
-    "b0456170-441f-4dc1-81ce-fe549d442e90": "f7d4c8a8-9028-4375-9908-1ee59aadc18b",
-    "b1c34d34-d086-4a08-9c96-df9b6dfe701f": "380e61f5-78a7-49c4-ba2e-013277f2741a",
-    "b4152ca1-4722-414a-8b43-7483154bf217": "a23b0140-42e6-43df-b303-34596cb389be",
-    "dd5043d8-02ef-4f94-877e-de236c048a02": "d9fd855e-d44b-48d0-aa0e-bf9c966e7ed9",
-    "f0a98df7-7b0a-4e60-bfe9-5ce419713d34": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
-    "7a54e27d-0908-45be-a4f2-5a32021e26f9": "f363a632-4b9f-41de-824b-43bd010b9975",
-    "48de8539-d700-4323-8e18-218c1751fd7b": "2aa7c158-875e-4cb1-96b1-65446917e4dc",
-    "da6224bd-b7a3-4d29-8ba4-337347cba745": "036f4e1b-75f9-428c-9bab-180547bfaa3c",
-    "d94e8c0d-15ac-47f6-92d1-d0fe6ffb99f8": "421943e9-2221-45f1-8f76-5a1ca012028e",
-    "6c990fb7-beca-4ce5-93a7-f19f5e591a4d": "b86508d5-1aba-45b0-b66a-c91f2efcd319",
-    "de4ba22d-37b4-43e9-8eaa-845f3e1b02b1": "fa52e0c6-656a-4812-818b-fb19455b1043",
-    "76675abf-c8de-4486-b673-587e3b3e7f8f": "421943e9-2221-45f1-8f76-5a1ca012028e",
-    "10843d4c-5522-4fb5-943c-9e4da8966d5a": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
-    "25776251-7a69-4265-a076-a3f8a526aee6": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
-    "2c4bc603-322a-4e7b-a5be-083ef3143583": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
-    "2d3fa0aa-5bc0-48a1-bcb6-ae05c94dfdb5": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
-    "2e104068-2394-4337-b87b-9c03b39ec552": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
-    "2f49c787-0e8a-40ca-adf2-0c665a93e942": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
-    "40a158db-0e11-466b-919d-ac4e4307ecea": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
-    "418737b1-8e60-4221-87cd-eb984ee47f10": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
-    "4f54a8d1-4c60-414a-8846-d60ecf37b50b": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
-    "50fa5f8e-5fcb-4407-aeb9-953c24fe192d": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
-    "6764ee42-09e3-4123-9e06-476b50fc1d8e": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
-    "a9aa77c8-8a75-4446-a4f9-7b42e5e84014": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
-    "c809fa61-8a3a-40c5-a25c-4fa7353b28d5": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
-    "e3976992-97b7-4e3a-8a8f-b21e531a5b77": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
-    "f0ce2fde-99a7-4619-8059-3ed902d6d301": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
-    "f973d4f4-e1d4-468c-a38b-ea5bcd6232f3": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
-}
+# 只读映射，用 MappingProxyType 包装以免运行中被意外修改
+uuid_mapping: Mapping[str, str] = MappingProxyType(
+    {
+        "1051f05f-d605-4b73-93b8-66c6e32c4979": "bce7437d-0243-4b03-8ee4-90cf069fb403",
+        "1a0bbc52-a927-45ef-b81d-a14c0442b563": "dce699fc-6878-43d6-b7fc-ce2d2d5afb40",
+        "1c30bd9d-a0be-434f-96a3-31a34291ebc6": "deff9fde-4542-4dad-aa60-15b8848b2513",
+        "1ed53623-0107-4b20-bd6b-699b27ad5b09": "84adfa36-69b7-491e-8faf-ecfeca08ba2c",
+        "268a5b81-1e53-42aa-aaf0-4d17936d7116": "039f9d39-4bc1-4569-b4c1-ae5b7c6483c1",
+        "2e0265e4-89b5-4977-86d4-96f961960561": "fcab9c9c-0be7-4d14-9172-72f10ee4282e",
+        "3f9e16ad-cd47-4910-a4e5-d8c222976791": "cad4cc4f-0073-42e8-8596-bd22a7f5193d",
+        "4091f5b5-f08e-45f3-ab0b-53249f3609e2": "f56964ac-6940-40b0-bb31-bd60afa064d2",
+        "596a0a0e-721a-4fc4-a49b-b54f612d75e5": "1d4628b8-c1e8-4c8c-9d75-c6cb08cead0c",
+        "77e8169b-e48f-43f0-b4ed-e9fd3c87805b": "23164b47-1cd4-4c39-b895-488eba89b8ab",
+        "7d25b953-39b3-41a3-aec3-3cfa5e2d7adb": "b916c283-7003-4bec-b1d1-950ecb5b79ff",
+        "888794e2-8d8a-4838-9d0f-d3e8d06d9b30": "3b57ce3f-e2d4-4165-844c-0d0d39fbbab2",
+        "8eb3efbf-b199-48b3-aa08-fd427ac91cc9": "7e30dae1-d1f8-47bd-a6ff-56ac5983e6e2",
+        "944d9a96-2774-4f4a-a9f9-422fb5f5f1a6": "ce79feda-4f5e-47fc-95bc-23f1e293570b",
+        "adb6b3e9-b7f5-4724-946a-ef35be51603e": "6a742fd3-f9e2-4edf-ab65-9208fae30d36",
+        "b0456170-441f-4dc1-81ce-fe549d442e90": "f7d4c8a8-9028-4375-9908-1ee59aadc18b",
+        "b1c34d34-d086-4a08-9c96-df9b6dfe701f": "380e61f5-78a7-49c4-ba2e-013277f2741a",
+        "b4152ca1-4722-414a-8b43-7483154bf217": "a23b0140-42e6-43df-b303-34596cb389be",
+        "dd5043d8-02ef-4f94-877e-de236c048a02": "d9fd855e-d44b-48d0-aa0e-bf9c966e7ed9",
+        "f0a98df7-7b0a-4e60-bfe9-5ce419713d34": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
+        "7a54e27d-0908-45be-a4f2-5a32021e26f9": "f363a632-4b9f-41de-824b-43bd010b9975",
+        "48de8539-d700-4323-8e18-218c1751fd7b": "2aa7c158-875e-4cb1-96b1-65446917e4dc",
+        "da6224bd-b7a3-4d29-8ba4-337347cba745": "036f4e1b-75f9-428c-9bab-180547bfaa3c",
+        "d94e8c0d-15ac-47f6-92d1-d0fe6ffb99f8": "421943e9-2221-45f1-8f76-5a1ca012028e",
+        "6c990fb7-beca-4ce5-93a7-f19f5e591a4d": "b86508d5-1aba-45b0-b66a-c91f2efcd319",
+        "de4ba22d-37b4-43e9-8eaa-845f3e1b02b1": "fa52e0c6-656a-4812-818b-fb19455b1043",
+        "76675abf-c8de-4486-b673-587e3b3e7f8f": "421943e9-2221-45f1-8f76-5a1ca012028e",
+        "10843d4c-5522-4fb5-943c-9e4da8966d5a": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
+        "25776251-7a69-4265-a076-a3f8a526aee6": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
+        "2c4bc603-322a-4e7b-a5be-083ef3143583": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
+        "2d3fa0aa-5bc0-48a1-bcb6-ae05c94dfdb5": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
+        "2e104068-2394-4337-b87b-9c03b39ec552": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
+        "2f49c787-0e8a-40ca-adf2-0c665a93e942": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
+        "40a158db-0e11-466b-919d-ac4e4307ecea": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
+        "418737b1-8e60-4221-87cd-eb984ee47f10": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
+        "4f54a8d1-4c60-414a-8846-d60ecf37b50b": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
+        "50fa5f8e-5fcb-4407-aeb9-953c24fe192d": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
+        "6764ee42-09e3-4123-9e06-476b50fc1d8e": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
+        "a9aa77c8-8a75-4446-a4f9-7b42e5e84014": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
+        "c809fa61-8a3a-40c5-a25c-4fa7353b28d5": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
+        "e3976992-97b7-4e3a-8a8f-b21e531a5b77": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
+        "f0ce2fde-99a7-4619-8059-3ed902d6d301": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
+        "f973d4f4-e1d4-468c-a38b-ea5bcd6232f3": "d46688e2-ace7-40ce-b76a-f89e11a016ff",
+    }
+)
 
 
 @dataclass(slots=True)
@@ -77,8 +95,18 @@ class MergeUpConfig:
     source_url: str
     leporid_url: str
     usagipass_url: str
-    batch_size: int = 500
+    batch_size: int = 5000
     dry_run: bool = False
+    # 默认所有迁移用户共用一个随机占位密码哈希；开启后为每位用户单独生成（多线程并行）
+    unique_password_hashes: bool = False
+    # 占位哈希的 Argon2 参数。占位密码是 32 字节随机数，无法被猜测，其安全性不依赖
+    # 哈希的计算成本，因此默认取较低的内存/时间开销；需要与线上参数一致时可调高。
+    argon2_time_cost: int = 1
+    argon2_memory_cost: int = 4096
+    argon2_parallelism: int = 1
+    argon2_hash_len: int = 32
+    # 迁移只在开头取出少数几个长连接，取连接前无需再发 ping 探活
+    pool_pre_ping: bool = False
 
 
 @dataclass(slots=True)
@@ -136,7 +164,7 @@ class SourcePreference:
 @dataclass(slots=True)
 class MigratedUser:
     source: SourceUser
-    new_user_id: str
+    new_user_id: uuid.UUID
     new_username: str
     prefer_server: str
     primary_account: SourceAccount
@@ -152,9 +180,11 @@ SERVER_RULES: Dict[str, dict] = {
 def run_merge_up(config: MergeUpConfig) -> MergeUpResult:
     """Entry point: coordinate merge-up migrations across three databases."""
 
-    source_engine = _create_engine(config.source_url, name="source")
-    leporid_engine = _create_engine(config.leporid_url, name="leporid")
-    usagipass_engine = _create_engine(config.usagipass_url, name="usagipass")
+    source_engine = _create_engine(config.source_url, name="source", config=config)
+    leporid_engine = _create_engine(config.leporid_url, name="leporid", config=config)
+    usagipass_engine = _create_engine(
+        config.usagipass_url, name="usagipass", config=config
+    )
 
     try:
         with (
@@ -162,32 +192,39 @@ def run_merge_up(config: MergeUpConfig) -> MergeUpResult:
             leporid_engine.connect() as leporid_conn,
             usagipass_engine.connect() as usagipass_conn,
         ):
-            source_tx = source_conn.begin()
-            leporid_tx = leporid_conn.begin()
-            usagipass_tx = usagipass_conn.begin()
+            # 三个连接各自一个事务，成败一致地提交或回滚
+            transactions = (
+                source_conn.begin(),
+                leporid_conn.begin(),
+                usagipass_conn.begin(),
+            )
             try:
                 result = _execute_merge_up(
                     source_conn=source_conn,
                     leporid_conn=leporid_conn,
                     usagipass_conn=usagipass_conn,
                     batch_size=config.batch_size,
+                    unique_password_hashes=config.unique_password_hashes,
+                    argon2_options={
+                        "time_cost": config.argon2_time_cost,
+                        "memory_cost": config.argon2_memory_cost,
+                        "parallelism": config.argon2_parallelism,
+                        "hash_len": config.argon2_hash_len,
+                    },
                 )
             except Exception:
                 logger.exception("迁移过程中发生错误，正在回滚")
-                source_tx.rollback()
-                leporid_tx.rollback()
-                usagipass_tx.rollback()
+                for transaction in transactions:
+                    transaction.rollback()
                 raise
             else:
                 if config.dry_run:
                     logger.info("dry-run 模式启用，所有更改已回滚")
-                    source_tx.rollback()
-                    leporid_tx.rollback()
-                    usagipass_tx.rollback()
+                    for transaction in transactions:
+                        transaction.rollback()
                 else:
-                    source_tx.commit()
-                    leporid_tx.commit()
-                    usagipass_tx.commit()
+                    for transaction in transactions:
+                        transaction.commit()
                     logger.info("迁移完成，所有更改已提交")
     finally:
         source_engine.dispose()
@@ -203,64 +240,89 @@ def _execute_merge_up(
     leporid_conn: Connection,
     usagipass_conn: Connection,
     batch_size: int,
+    unique_password_hashes: bool,
+    argon2_options: Mapping[str, int],
 ) -> MergeUpResult:
-    users = _load_source_users(source_conn)
-    accounts = _load_source_accounts(source_conn)
-    preferences = _load_source_preferences(source_conn)
-    images = _load_source_images(source_conn)
-
-    accounts_by_user: Dict[str, List[SourceAccount]] = defaultdict(list)
-    for account in accounts:
-        accounts_by_user[account.username].append(account)
+    # 整次运行共用一个“当前时间”，用于补齐缺失的时间戳与写入 updated_at
+    now = _utcnow()
 
-    preferences_by_user = {pref.username: pref for pref in preferences}
+    # 用户及其账号按需从源库流式读出；偏好设置在读取过程中顺带收集，供后续阶段使用
+    preferences_by_user: Dict[str, SourcePreference] = {}
+    users = _load_source_users(source_conn, batch_size, preferences_by_user, now)
+    images = _load_source_images(source_conn, batch_size)
 
     existing_users = _collect_existing_usernames(leporid_conn)
     server_ids = _load_server_ids(usagipass_conn)
 
-    users_result, migrated_users, leporid_payload = _migrate_users(
-        users=users,
-        accounts_by_user=accounts_by_user,
-        existing_users=existing_users,
-    )
+    users_result = MergeSectionResult()
+    migrated_users: List[MigratedUser] = []
 
-    _upsert_leporid_users(leporid_conn, leporid_payload, batch_size)
+    def leporid_rows(password_hashes: Iterator[str]) -> Iterator[tuple]:
+        for migrated, row in _migrate_users(
+            users=users,
+            existing_users=existing_users,
+            password_hashes=password_hashes,
+            summary=users_result,
+        ):
+            migrated_users.append(migrated)
+            yield row
+
+    # 用户行边生成边按批写入，不在内存中保留整份 tbl_user 载荷
+    with _password_hashes(
+        unique_password_hashes, batch_size, argon2_options
+    ) as password_hashes:
+        _upsert_leporid_users(leporid_conn, leporid_rows(password_hashes), batch_size)
+
+    # leporid 与 usagipass 两侧的写入互不依赖，分两个阶段在后台线程与主线程间交替：
+    #   1. 后台：第三方绑定、图片 uuid 映射（leporid + 源库）；主线程：账号、rating（usagipass）
+    #   2. 后台：偏好设置（usagipass）；主线程：图片（leporid + 源库）
+    # 仍沿用各自的连接与事务（外键需要看到尚未提交的用户，回滚也需一致），
+    # 每个连接同一时刻只由一个线程使用；单个后台线程按提交顺序依次执行任务。
+    accounts_by_server = _group_supported_accounts(migrated_users)
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="merge-up") as pool:
+        third_future = pool.submit(
+            _migrate_third_parties,
+            leporid_conn=leporid_conn,
+            accounts_by_server=accounts_by_server,
+            batch_size=batch_size,
+        )
+        lookup_future = pool.submit(
+            _build_image_uuid_lookup, source_conn, leporid_conn, batch_size
+        )
 
-    third_result = _migrate_third_parties(
-        leporid_conn=leporid_conn,
-        migrated_users=migrated_users,
-        batch_size=batch_size,
-    )
+        account_result = _migrate_accounts(
+            usagipass_conn=usagipass_conn,
+            accounts_by_server=accounts_by_server,
+            server_ids=server_ids,
+            batch_size=batch_size,
+        )
 
-    account_result = _migrate_accounts(
-        usagipass_conn=usagipass_conn,
-        migrated_users=migrated_users,
-        server_ids=server_ids,
-        batch_size=batch_size,
-    )
+        rating_result = _migrate_ratings(
+            usagipass_conn=usagipass_conn,
+            migrated_users=migrated_users,
+            batch_size=batch_size,
+        )
 
-    rating_result = _migrate_ratings(
-        usagipass_conn=usagipass_conn,
-        migrated_users=migrated_users,
-        batch_size=batch_size,
-    )
+        third_result = third_future.result()
+        preference_future = pool.submit(
+            _migrate_preferences,
+            usagipass_conn=usagipass_conn,
+            migrated_users=migrated_users,
+            preferences_by_user=preferences_by_user,
+            image_uuid_lookup=lookup_future.result(),
+            batch_size=batch_size,
+        )
 
-    preference_result = _migrate_preferences(
-        source_conn=source_conn,
-        usagipass_conn=usagipass_conn,
-        leporid_conn=leporid_conn,
-        migrated_users=migrated_users,
-        preferences_by_user=preferences_by_user,
-        batch_size=batch_size,
-    )
+        ensure_required_aspects(leporid_conn)
+        image_result = _migrate_images(
+            source_images=images,
+            leporid_conn=leporid_conn,
+            migrated_users={user.source.username: user for user in migrated_users},
+            batch_size=batch_size,
+            now=now,
+        )
 
-    ensure_required_aspects(leporid_conn)
-    image_result = _migrate_images(
-        source_images=images,
-        leporid_conn=leporid_conn,
-        migrated_users={user.source.username: user for user in migrated_users},
-        batch_size=batch_size,
-    )
+        preference_result = preference_future.result()
 
     return MergeUpResult(
         users=users_result,
@@ -272,120 +334,170 @@ def _execute_merge_up(
     )
 
 
-def _load_source_users(conn: Connection) -> List[SourceUser]:
-    rows = conn.execute(
-        text(
-            """
-            SELECT username, prefer_server, created_at, updated_at
-            FROM users
-            ORDER BY username
-            """
-        )
-    )
-    result: List[SourceUser] = []
-    for row in rows:
-        result.append(
-            SourceUser(
-                username=row.username,
-                prefer_server=(row.prefer_server or "").upper(),
-                created_at=_ensure_datetime(row.created_at),
-                updated_at=_ensure_datetime(row.updated_at),
-            )
-        )
-    return result
+_SELECT_SOURCE_USERS = text(
+    """
+    SELECT u.username, u.prefer_server, u.created_at, u.updated_at,
+           a.username AS account_username, a.account_name, a.account_server, a.account_password,
+           a.nickname, a.bind_qq, a.player_rating,
+           a.created_at AS account_created_at, a.updated_at AS account_updated_at,
+           p.username AS pref_username,
+           COALESCE(p.maimai_version, '') AS maimai_version,
+           COALESCE(p.simplified_code, '') AS simplified_code,
+           COALESCE(p.character_name, '') AS character_name,
+           COALESCE(p.friend_code, '') AS friend_code,
+           COALESCE(p.display_name, '') AS display_name,
+           COALESCE(p.dx_rating, '') AS dx_rating,
+           COALESCE(NULLIF(p.qr_size, 0), 15) AS qr_size,
+           COALESCE(p.mask_type, 0) AS mask_type,
+           COALESCE(p.character_id, '') AS character_id,
+           COALESCE(p.background_id, '') AS background_id,
+           COALESCE(p.frame_id, '') AS frame_id,
+           COALESCE(p.passname_id, '') AS passname_id,
+           COALESCE(NULLIF(p.chara_info_color, ''), '#fee37c') AS chara_info_color,
+           p.show_date
+    FROM users u
+    LEFT JOIN user_accounts a ON a.username = u.username
+    LEFT JOIN (
+        SELECT up.*, ROW_NUMBER() OVER (PARTITION BY up.username) AS pref_rank
+        FROM user_preferences up
+    ) p ON p.username = u.username AND p.pref_rank = 1
+    ORDER BY u.username, a.account_server
+    """
+)
+
+
+# 这些方言的驱动只会返回不带时区的 datetime（或 NULL）
+_NAIVE_DATETIME_DIALECTS = frozenset({"mysql", "mariadb"})
 
 
-def _load_source_accounts(conn: Connection) -> List[SourceAccount]:
+def _load_source_users(
+    conn: Connection,
+    batch_size: int,
+    preferences_by_user: Dict[str, SourcePreference],
+    now: datetime,
+) -> Iterator[tuple[SourceUser, Sequence[SourceAccount]]]:
+    """Stream users with their accounts from one joined query.
+
+    Rows come back one per (user, account) ordered by username, so a single
+    `groupby` pass yields each user together with all of its accounts. The
+    preferences found along the way are stored into `preferences_by_user`.
+    Preferences are joined from a derived table ranked per username, so a
+    duplicated `user_preferences` row cannot repeat the user's accounts; which
+    of the duplicates is kept is unspecified.
+    """
     rows = conn.execute(
-        text(
-            """
-            SELECT account_name, account_server, account_password, nickname, bind_qq, player_rating, username, created_at, updated_at
-            FROM user_accounts
-            ORDER BY username, account_server
-            """
-        )
+        _SELECT_SOURCE_USERS,
+        execution_options=_stream_options(batch_size),
     )
-    result: List[SourceAccount] = []
-    for row in rows:
-        result.append(
+    # MySQL/MariaDB 驱动返回的时间均为不带时区的 datetime，只需给 NULL 补上当前时间；
+    # 其他驱动可能返回带时区的值，仍逐个交给 _ensure_datetime 规范化
+    naive = conn.dialect.name in _NAIVE_DATETIME_DIALECTS
+
+    for username, group in groupby(rows, key=attrgetter("username")):
+        first = next(group)
+        if naive:
+            created_at = first.created_at or now
+            updated_at = first.updated_at or now
+        else:
+            created_at = _ensure_datetime(first.created_at, now=now)
+            updated_at = _ensure_datetime(first.updated_at, now=now)
+        user = SourceUser(
+            username=username,
+            prefer_server=(first.prefer_server or "").upper(),
+            created_at=created_at,
+            updated_at=updated_at,
+        )
+        if first.pref_username is not None:
+            # 偏好列的空值默认值已在查询中用 COALESCE 补齐
+            preferences_by_user[username] = SourcePreference(
+                username=username,
+                maimai_version=first.maimai_version,
+                simplified_code=first.simplified_code,
+                character_name=first.character_name,
+                friend_code=first.friend_code,
+                display_name=first.display_name,
+                dx_rating=first.dx_rating,
+                qr_size=first.qr_size,
+                mask_type=first.mask_type,
+                character_id=first.character_id,
+                background_id=first.background_id,
+                frame_id=first.frame_id,
+                passname_id=first.passname_id,
+                chara_info_color=first.chara_info_color,
+                show_date=_coerce_bool(first.show_date, default=True),
+            )
+
+        # LEFT JOIN 下没有账号的用户只有一行，且账号列全为 NULL
+        if first.account_username is None:
+            yield user, ()
+            continue
+        yield user, [
             SourceAccount(
-                username=row.username,
+                username=username,
                 account_name=row.account_name,
                 account_server=(row.account_server or "").upper(),
                 account_password=row.account_password,
                 nickname=row.nickname,
                 bind_qq=row.bind_qq,
                 player_rating=row.player_rating or 0,
-                created_at=_ensure_datetime(row.created_at),
-                updated_at=_ensure_datetime(row.updated_at),
+                created_at=(
+                    row.account_created_at or now
+                    if naive
+                    else _ensure_datetime(row.account_created_at, now=now)
+                ),
+                updated_at=(
+                    row.account_updated_at or now
+                    if naive
+                    else _ensure_datetime(row.account_updated_at, now=now)
+                ),
             )
-        )
-    return result
+            for row in chain((first,), group)
+        ]
 
 
-def _load_source_preferences(conn: Connection) -> List[SourcePreference]:
-    rows = conn.execute(
-        text(
-            """
-            SELECT username, maimai_version, simplified_code, character_name, friend_code, display_name, dx_rating,
-                   qr_size, mask_type, character_id, background_id, frame_id, passname_id, chara_info_color, show_date
-            FROM user_preferences
-            """
-        )
-    )
-    result: List[SourcePreference] = []
-    for row in rows:
-        result.append(
-            SourcePreference(
-                username=row.username,
-                maimai_version=_null_to_empty(row.maimai_version),
-                simplified_code=_null_to_empty(row.simplified_code),
-                character_name=_null_to_empty(row.character_name),
-                friend_code=_null_to_empty(row.friend_code),
-                display_name=_null_to_empty(row.display_name),
-                dx_rating=_null_to_empty(row.dx_rating),
-                qr_size=row.qr_size or 15,
-                mask_type=row.mask_type or 0,
-                character_id=_null_to_empty(row.character_id),
-                background_id=_null_to_empty(row.background_id),
-                frame_id=_null_to_empty(row.frame_id),
-                passname_id=_null_to_empty(row.passname_id),
-                chara_info_color=_null_to_empty(row.chara_info_color) or "#fee37c",
-                show_date=_coerce_bool(row.show_date, default=True),
-            )
-        )
-    return result
+_SELECT_SOURCE_IMAGES = text(
+    """
+    SELECT id, name, kind, sega_name, uploaded_by, uploaded_at
+    FROM images
+    WHERE uploaded_by IS NOT NULL
+    ORDER BY uploaded_at, id
+    """
+)
 
 
-def _load_source_images(conn: Connection):
-    return list(
-        conn.execute(
-            text(
-                """
-                SELECT id, name, kind, sega_name, uploaded_by, uploaded_at
-                FROM images
-                WHERE uploaded_by IS NOT NULL
-                ORDER BY uploaded_at, id
-                """
-            )
-        )
+def _load_source_images(conn: Connection, batch_size: int) -> Iterator[Row]:
+    # 生成器：查询推迟到 _migrate_images 开始迭代时才执行，此前源库连接上的其他查询
+    # 均已完成（MySQL 的流式游标未读完前，同一连接不能再执行查询）。
+    yield from conn.execute(
+        _SELECT_SOURCE_IMAGES,
+        execution_options=_stream_options(batch_size),
     )
 
 
-def _collect_existing_usernames(conn: Connection) -> Dict[str, str]:
-    rows = conn.execute(text("SELECT username, id FROM tbl_user"))
-    return {str(row.username): str(row.id) for row in rows}
+_SELECT_EXISTING_USERS = text("SELECT username, id FROM tbl_user")
+
+
+def _collect_existing_usernames(conn: Connection) -> Dict[str, uuid.UUID]:
+    # username 是文本列，驱动已返回 str；id 是 uuid 列，保留驱动返回的 uuid.UUID，
+    # 写回目标库时由驱动直接按 uuid 类型传输
+    rows = conn.execute(_SELECT_EXISTING_USERS)
+    return {username: user_id for username, user_id in rows}
+
+
+# 只取迁移用到的 server 标识，标识的规范化（去空白、转小写）在库内完成
+_SELECT_SERVER_IDS = text(
+    """
+    SELECT lower(trim(identifier)) AS identifier, id
+    FROM tbl_server
+    WHERE lower(trim(identifier)) IN :identifiers
+    """
+).bindparams(bindparam("identifiers", expanding=True))
 
 
 def _load_server_ids(conn: Connection) -> Dict[str, int]:
-    rows = conn.execute(text("SELECT id, identifier FROM tbl_server"))
-    mapping: Dict[str, int] = {}
-    for row in rows:
-        identifier = (row.identifier or "").strip().lower()
-        if not identifier:
-            continue
-        mapping[identifier] = int(row.id)
-    required = {"divingfish", "lxns"}
+    required = {rule["identifier"] for rule in SERVER_RULES.values()}
+    rows = conn.execute(_SELECT_SERVER_IDS, {"identifiers": sorted(required)})
+    mapping = {row.identifier: int(row.id) for row in rows}
     missing = required - mapping.keys()
     if missing:
         raise RuntimeError(
@@ -396,18 +508,18 @@ def _load_server_ids(conn: Connection) -> Dict[str, int]:
 
 def _migrate_users(
     *,
-    users: Sequence[SourceUser],
-    accounts_by_user: Mapping[str, Sequence[SourceAccount]],
-    existing_users: Dict[str, str],
-) -> tuple[MergeSectionResult, List[MigratedUser], List[dict]]:
-    summary = MergeSectionResult()
-    migrated: List[MigratedUser] = []
-    payload: List[dict] = []
-
-    for user in users:
+    users: Iterable[tuple[SourceUser, Sequence[SourceAccount]]],
+    existing_users: Dict[str, uuid.UUID],
+    password_hashes: Iterator[str],
+    summary: MergeSectionResult,
+) -> Iterator[tuple[MigratedUser, tuple]]:
+    """Yield each migrated user with its tbl_user row, counting into `summary`."""
+    new_ids = uuid4_stream()
+    rules = SERVER_RULES
+
+    for user, accounts in users:
         summary.processed += 1
 
-        accounts = list(accounts_by_user.get(user.username, ()))
         if not accounts:
             summary.skipped += 1
             logger.warning(
@@ -416,10 +528,14 @@ def _migrate_users(
             )
             continue
 
-        primary = _select_primary_account(user.prefer_server, accounts)
-        if primary is None or primary.account_server not in SERVER_RULES:
+        # 每个用户只建一次 服务器 -> 账号 字典，首选与回退都在其上查找
+        by_server = _accounts_by_server(accounts)
+        primary = by_server.get(user.prefer_server)
+        server_rule = rules.get(primary.account_server) if primary else None
+        if server_rule is None:
+            # 字典按账号首次出现的顺序排列，结果与按原列表查找第一个受支持账号一致
             primary = next(
-                (acct for acct in accounts if acct.account_server in SERVER_RULES),
+                (acct for server, acct in by_server.items() if server in rules),
                 None,
             )
             if primary is None:
@@ -429,6 +545,7 @@ def _migrate_users(
                     user.username,
                 )
                 continue
+            server_rule = rules[primary.account_server]
             logger.info(
                 "用户 %s 的首选服务器 %s 不可用，改用账号 %s 的服务器 %s",
                 user.username,
@@ -437,38 +554,16 @@ def _migrate_users(
                 primary.account_server,
             )
 
-        server_rule = SERVER_RULES.get(primary.account_server)
-        if server_rule is None:
-            summary.skipped += 1
-            logger.warning(
-                "跳过用户 %s：无法识别的服务器 %s",
-                user.username,
-                primary.account_server,
-            )
-            continue
-
         new_username = f"{server_rule['prefix']}{primary.account_name}"
         if new_username in existing_users:
             new_user_id = existing_users[new_username]
             summary.updated += 1
         else:
-            new_user_id = str(uuid.uuid4())
+            new_user_id = next(new_ids)
             existing_users[new_username] = new_user_id
             summary.inserted += 1
 
-        payload.append(
-            {
-                "id": new_user_id,
-                "username": new_username,
-                "hashed_password": _generate_password_hash(),
-                "email": "",
-                "permissions": "{}",
-                "created_at": user.created_at,
-                "updated_at": user.updated_at,
-            }
-        )
-
-        migrated.append(
+        yield (
             MigratedUser(
                 source=user,
                 new_user_id=new_user_id,
@@ -476,186 +571,190 @@ def _migrate_users(
                 prefer_server=primary.account_server,
                 primary_account=primary,
                 accounts=accounts,
-            )
+            ),
+            (
+                new_user_id,
+                new_username,
+                next(password_hashes),
+                "",
+                _EMPTY_PERMISSIONS,
+                user.created_at,
+                user.updated_at,
+            ),
         )
 
-    return summary, migrated, payload
+
+# 新用户没有任何权限，写入 PostgreSQL 空数组字面量
+_EMPTY_PERMISSIONS = "{}"
+
+# 用户、第三方绑定与账号的行直接按列顺序组装成元组，省去逐行构造字典再按列名取值
+_USER_COLUMNS = (
+    "id",
+    "username",
+    "hashed_password",
+    "email",
+    "permissions",
+    "created_at",
+    "updated_at",
+)
+_USER_UPSERT = StagedUpsert(
+    "tbl_user",
+    _USER_COLUMNS,
+    conflict=("id",),
+    update=("username", "hashed_password", "email", "permissions", "updated_at"),
+)
 
 
 def _upsert_leporid_users(
-    conn: Connection, payload: Sequence[dict], batch_size: int
+    conn: Connection, rows: Iterable[tuple], batch_size: int
 ) -> None:
-    for chunk in _chunked(payload, batch_size):
-        if not chunk:
-            continue
-        conn.execute(
-            text(
-                """
-                INSERT INTO tbl_user (id, username, hashed_password, email, permissions, created_at, updated_at)
-                VALUES (:id, :username, :hashed_password, :email, :permissions, :created_at, :updated_at)
-                ON CONFLICT (id) DO UPDATE SET
-                    username = EXCLUDED.username,
-                    hashed_password = EXCLUDED.hashed_password,
-                    email = EXCLUDED.email,
-                    permissions = EXCLUDED.permissions,
-                    updated_at = EXCLUDED.updated_at
-                """
-            ),
-            chunk,
-        )
+    # rows 是边迁移边生成的用户行，无法按下标切片；_chunked 对序列切片、
+    # 对生成器用 islice 取批，且不会产出空批次
+    for chunk in _chunked(rows, batch_size):
+        _USER_UPSERT.execute(conn, chunk)
+
+
+def _group_supported_accounts(
+    migrated_users: Sequence[MigratedUser],
+) -> Dict[str, List[tuple[MigratedUser, SourceAccount]]]:
+    """Bucket every account of a supported server by that server, once per run.
+
+    Third parties and accounts both walk these buckets, so neither has to look
+    up the server rule of each account. Within a bucket the accounts keep the
+    order of `migrated_users`.
+    """
+    buckets: Dict[str, List[tuple[MigratedUser, SourceAccount]]] = {
+        server: [] for server in SERVER_RULES
+    }
+    for user in migrated_users:
+        for account in user.accounts:
+            bucket = buckets.get(account.account_server)
+            if bucket is not None:
+                bucket.append((user, account))
+    return buckets
 
 
 def _migrate_third_parties(
     *,
     leporid_conn: Connection,
-    migrated_users: Sequence[MigratedUser],
+    accounts_by_server: Mapping[str, Sequence[tuple[MigratedUser, SourceAccount]]],
     batch_size: int,
 ) -> MergeSectionResult:
     summary = MergeSectionResult()
-    existing = {
-        (str(row.username), int(row.strategy)): str(row.id)
-        for row in leporid_conn.execute(
-            text("SELECT id, username, strategy FROM tbl_user_third_party")
-        )
-    }
 
-    payload: List[dict] = []
-    for user in migrated_users:
-        for account in user.accounts:
-            rule = SERVER_RULES.get(account.account_server)
-            if rule is None:
-                continue
-            summary.processed += 1
-            key = (account.account_name, rule["strategy"])
-            if key in existing:
-                entry_id = existing[key]
-                summary.updated += 1
-            else:
-                entry_id = str(uuid.uuid4())
-                existing[key] = entry_id
-                summary.inserted += 1
-
-            payload.append(
-                {
-                    "id": entry_id,
-                    "user_id": user.new_user_id,
-                    "username": account.account_name,
-                    "strategy": rule["strategy"],
-                    "created_at": account.created_at,
-                    "updated_at": account.updated_at,
-                }
-            )
-
-            if len(payload) >= batch_size:
-                _upsert_third_party(leporid_conn, payload)
-                payload.clear()
+    # 已存在的 (username, strategy) 在写入时由数据库匹配并沿用原 id，新增/更新数由 RETURNING 统计
+    new_ids = uuid4_stream(batch_size)
+
+    def rows() -> Iterator[tuple]:
+        for server, accounts in accounts_by_server.items():
+            strategy = SERVER_RULES[server]["strategy"]
+            for user, account in accounts:
+                summary.processed += 1
+                yield (
+                    next(new_ids),
+                    user.new_user_id,
+                    account.account_name,
+                    strategy,
+                    account.created_at,
+                    account.updated_at,
+                )
 
-    if payload:
-        _upsert_third_party(leporid_conn, payload)
+    for chunk in _chunked(rows(), batch_size):
+        _tally(summary, chunk, _upsert_third_party(leporid_conn, chunk))
 
     return summary
 
 
-def _upsert_third_party(conn: Connection, payload: Sequence[dict]) -> None:
-    conn.execute(
-        text(
-            """
-            INSERT INTO tbl_user_third_party (id, user_id, username, strategy, created_at, updated_at)
-            VALUES (:id, :user_id, :username, :strategy, :created_at, :updated_at)
-            ON CONFLICT (id) DO UPDATE SET
-                user_id = EXCLUDED.user_id,
-                username = EXCLUDED.username,
-                strategy = EXCLUDED.strategy,
-                updated_at = EXCLUDED.updated_at
-            """
-        ),
-        payload,
-    )
+_THIRD_PARTY_COLUMNS = (
+    "id",
+    "user_id",
+    "username",
+    "strategy",
+    "created_at",
+    "updated_at",
+)
+_THIRD_PARTY_UPSERT = StagedUpsert(
+    "tbl_user_third_party",
+    _THIRD_PARTY_COLUMNS,
+    conflict=("id",),
+    update=("user_id", "username", "strategy", "updated_at"),
+    match=("username", "strategy"),
+)
+
+
+def _upsert_third_party(conn: Connection, payload: Sequence[tuple]) -> int:
+    return _THIRD_PARTY_UPSERT.execute(conn, payload)
 
 
 def _migrate_accounts(
     *,
     usagipass_conn: Connection,
-    migrated_users: Sequence[MigratedUser],
+    accounts_by_server: Mapping[str, Sequence[tuple[MigratedUser, SourceAccount]]],
     server_ids: Mapping[str, int],
     batch_size: int,
 ) -> MergeSectionResult:
     summary = MergeSectionResult()
-    existing = {
-        (str(row.user_id), int(row.server_id)): str(row.id)
-        for row in usagipass_conn.execute(
-            text("SELECT id, user_id, server_id FROM tbl_account")
-        )
-    }
 
-    payload: List[dict] = []
-    for user in migrated_users:
-        for account in user.accounts:
-            rule = SERVER_RULES.get(account.account_server)
-            if rule is None:
-                continue
-            identifier = rule["identifier"]
+    # 已存在的 (user_id, server_id) 在写入时由数据库匹配并沿用原 id，新增/更新数由 RETURNING 统计
+    new_ids = uuid4_stream(batch_size)
+
+    def rows() -> Iterator[tuple]:
+        # 按服务器分组后，server id 与是否跳过每组只需判断一次
+        for server, accounts in accounts_by_server.items():
+            identifier = SERVER_RULES[server]["identifier"]
             server_id = server_ids.get(identifier)
             if server_id is None:
-                logger.warning(
-                    "跳过账号 %s：未在 usagipass 找到 server %s",
-                    account.account_name,
-                    identifier,
-                )
+                for _, account in accounts:
+                    logger.warning(
+                        "跳过账号 %s：未在 usagipass 找到 server %s",
+                        account.account_name,
+                        identifier,
+                    )
                 continue
-            summary.processed += 1
-            key = (user.new_user_id, server_id)
-            if key in existing:
-                entry_id = existing[key]
-                summary.updated += 1
-            else:
-                entry_id = str(uuid.uuid4())
-                existing[key] = entry_id
-                summary.inserted += 1
 
-            if account.account_server == "DIVING_FISH":
+            summary.processed += len(accounts)
+            # 水鱼账号不写入 usagipass
+            if server == "DIVING_FISH":
+                summary.skipped += len(accounts)
                 continue
 
-            credentials = account.account_password
-
-            payload.append(
-                {
-                    "id": entry_id,
-                    "user_id": user.new_user_id,
-                    "server_id": server_id,
-                    "credentials": credentials,
-                    "enabled": True,
-                    "created_at": account.created_at,
-                    "updated_at": account.updated_at,
-                }
-            )
-
-            if len(payload) >= batch_size:
-                _upsert_accounts(usagipass_conn, payload)
-                payload.clear()
+            for user, account in accounts:
+                yield (
+                    next(new_ids),
+                    user.new_user_id,
+                    server_id,
+                    account.account_password,
+                    True,
+                    account.created_at,
+                    account.updated_at,
+                )
 
-    if payload:
-        _upsert_accounts(usagipass_conn, payload)
+    for chunk in _chunked(rows(), batch_size):
+        _tally(summary, chunk, _upsert_accounts(usagipass_conn, chunk))
 
     return summary
 
 
-def _upsert_accounts(conn: Connection, payload: Sequence[dict]) -> None:
-    conn.execute(
-        text(
-            """
-            INSERT INTO tbl_account (id, user_id, server_id, credentials, enabled, created_at, updated_at)
-            VALUES (:id, :user_id, :server_id, :credentials, :enabled, :created_at, :updated_at)
-            ON CONFLICT (id) DO UPDATE SET
-                user_id = EXCLUDED.user_id,
-                server_id = EXCLUDED.server_id,
-                credentials = EXCLUDED.credentials,
-                enabled = EXCLUDED.enabled,
-                updated_at = EXCLUDED.updated_at
-            """
-        ),
-        payload,
-    )
+_ACCOUNT_COLUMNS = (
+    "id",
+    "user_id",
+    "server_id",
+    "credentials",
+    "enabled",
+    "created_at",
+    "updated_at",
+)
+_ACCOUNT_UPSERT = StagedUpsert(
+    "tbl_account",
+    _ACCOUNT_COLUMNS,
+    conflict=("id",),
+    update=("user_id", "server_id", "credentials", "enabled", "updated_at"),
+    match=("user_id", "server_id"),
+)
+
+
+def _upsert_accounts(conn: Connection, payload: Sequence[tuple]) -> int:
+    return _ACCOUNT_UPSERT.execute(conn, payload)
 
 
 def _migrate_ratings(
@@ -665,443 +764,573 @@ def _migrate_ratings(
     batch_size: int,
 ) -> MergeSectionResult:
     summary = MergeSectionResult()
-    existing_users = {
-        str(row.user_id)
-        for row in usagipass_conn.execute(text("SELECT user_id FROM tbl_rating"))
-    }
-    payload: List[dict] = []
-    for user in migrated_users:
-        summary.processed += 1
-        payload.append(
-            {
+
+    def rows() -> Iterator[dict]:
+        for user in migrated_users:
+            summary.processed += 1
+            yield {
                 "user_id": user.new_user_id,
                 "name": "",
                 "rating": user.primary_account.player_rating,
                 "friend_code": "",
                 "updated_at": user.primary_account.updated_at,
             }
-        )
-        if user.new_user_id in existing_users:
-            summary.updated += 1
-        else:
-            summary.inserted += 1
-            existing_users.add(user.new_user_id)
 
-        if len(payload) >= batch_size:
-            _upsert_ratings(usagipass_conn, payload)
-            payload.clear()
-
-    if payload:
-        _upsert_ratings(usagipass_conn, payload)
+    for chunk in _chunked(rows(), batch_size):
+        _tally(summary, chunk, _upsert_ratings(usagipass_conn, chunk))
 
     return summary
 
 
-def _upsert_ratings(conn: Connection, payload: Sequence[dict]) -> None:
-    conn.execute(
-        text(
-            """
-            INSERT INTO tbl_rating (user_id, name, rating, friend_code, updated_at)
-            VALUES (:user_id, :name, :rating, :friend_code, :updated_at)
-            ON CONFLICT (user_id) DO UPDATE SET
-                name = EXCLUDED.name,
-                rating = EXCLUDED.rating,
-                friend_code = EXCLUDED.friend_code,
-                updated_at = EXCLUDED.updated_at
-            """
-        ),
-        payload,
-    )
+_RATING_COLUMNS = (
+    "user_id",
+    "name",
+    "rating",
+    "friend_code",
+    "updated_at",
+)
+_RATING_UPSERT = StagedUpsert(
+    "tbl_rating",
+    _RATING_COLUMNS,
+    conflict=("user_id",),
+    update=("name", "rating", "friend_code", "updated_at"),
+)
+
+
+def _upsert_ratings(conn: Connection, payload: Sequence[dict]) -> int:
+    return _upsert(conn, _RATING_UPSERT, payload)
 
 
 def _migrate_preferences(
     *,
-    source_conn: Connection,
     usagipass_conn: Connection,
-    leporid_conn: Connection,
     migrated_users: Sequence[MigratedUser],
     preferences_by_user: Mapping[str, SourcePreference],
+    image_uuid_lookup: Mapping[str, str],
     batch_size: int,
 ) -> MergeSectionResult:
     summary = MergeSectionResult()
-    existing_users = {
-        str(row.user_id)
-        for row in usagipass_conn.execute(text("SELECT user_id FROM tbl_preference"))
-    }
-    image_uuid_lookup = _build_image_uuid_lookup(source_conn, leporid_conn)
-
-    payload: List[dict] = []
-    for user in migrated_users:
-        summary.processed += 1
-        pref = preferences_by_user.get(user.source.username)
-        payload.append(_build_preference_row(user, pref, image_uuid_lookup))
-        if user.new_user_id in existing_users:
-            summary.updated += 1
-        else:
-            summary.inserted += 1
-            existing_users.add(user.new_user_id)
+    # 源库 sega_name 匹配结果优先于硬编码映射；预先合并后每个字段只需查一次字典
+    references = {**uuid_mapping, **image_uuid_lookup}
 
-        if len(payload) >= batch_size:
-            _upsert_preferences(usagipass_conn, payload)
-            payload.clear()
+    def rows() -> Iterator[dict]:
+        for user in migrated_users:
+            summary.processed += 1
+            pref = preferences_by_user.get(user.source.username)
+            yield _build_preference_row(user, pref, references)
 
-    if payload:
-        _upsert_preferences(usagipass_conn, payload)
+    for chunk in _chunked(rows(), batch_size):
+        _tally(summary, chunk, _upsert_preferences(usagipass_conn, chunk))
 
     return summary
 
 
-def _build_preference_row(
-    user: MigratedUser,
-    pref: SourcePreference | None,
-    image_uuid_lookup: Mapping[str, str],
-) -> dict:
-    pref = pref or SourcePreference(
-        username=user.source.username,
-        maimai_version="",
-        simplified_code="",
-        character_name="",
-        friend_code="",
-        display_name="",
-        dx_rating="",
-        qr_size=15,
-        mask_type=0,
-        character_id="",
-        background_id="",
-        frame_id="",
-        passname_id="",
-        chara_info_color="#fee37c",
-        show_date=True,
-    )
+# 没有偏好设置的用户共用同一份默认值，不再逐个构造；username 不参与生成目标行
+_DEFAULT_PREFERENCE = SourcePreference(
+    username="",
+    maimai_version="",
+    simplified_code="",
+    character_name="",
+    friend_code="",
+    display_name="",
+    dx_rating="",
+    qr_size=15,
+    mask_type=0,
+    character_id="",
+    background_id="",
+    frame_id="",
+    passname_id="",
+    chara_info_color="#fee37c",
+    show_date=True,
+)
+
 
-    character_id = _resolve_image_reference(pref.character_id, image_uuid_lookup)
-    background_id = _resolve_image_reference(pref.background_id, image_uuid_lookup)
-    frame_id = _resolve_image_reference(pref.frame_id, image_uuid_lookup)
-    passname_id = _resolve_image_reference(pref.passname_id, image_uuid_lookup)
-
-    return {
-        "user_id": user.new_user_id,
-        "maimai_version": pref.maimai_version,
-        "simplified_code": pref.simplified_code,
-        "character_name": pref.character_name,
-        "friend_code": pref.friend_code,
-        "display_name": pref.display_name,
-        "dx_rating": pref.dx_rating,
-        "qr_size": pref.qr_size,
-        "mask_type": pref.mask_type,
+# 所有用户都相同的固定字段；逐行从模板复制再填入随用户变化的字段，
+# 比每次构造完整的字典字面量更快
+_PREFERENCE_TEMPLATE: MappingProxyType[str, object] = MappingProxyType(
+    {
         "player_info_color": "#ffffff",
-        "chara_info_color": pref.chara_info_color or "#fee37c",
         "show_dx_rating": True,
         "show_display_name": True,
         "show_friend_code": True,
         "enable_mask": False,
-        "show_date": pref.show_date,
-        "character_id": character_id,
         "mask_id": "",
-        "background_id": background_id,
-        "frame_id": frame_id,
-        "passname_id": passname_id,
     }
+)
+
+
+def _build_preference_row(
+    user: MigratedUser,
+    pref: SourcePreference | None,
+    references: Mapping[str, str],
+) -> dict:
+    pref = pref or _DEFAULT_PREFERENCE
+
+    # references 已合并 uuid_mapping，未匹配的引用保持原值
+    get = references.get
+    character_id, background_id, frame_id, passname_id = (
+        get(value, value)
+        for value in (
+            pref.character_id,
+            pref.background_id,
+            pref.frame_id,
+            pref.passname_id,
+        )
+    )
+
+    row = _PREFERENCE_TEMPLATE.copy()
+    row["user_id"] = user.new_user_id
+    row["maimai_version"] = pref.maimai_version
+    row["simplified_code"] = pref.simplified_code
+    row["character_name"] = pref.character_name
+    row["friend_code"] = pref.friend_code
+    row["display_name"] = pref.display_name
+    row["dx_rating"] = pref.dx_rating
+    row["qr_size"] = pref.qr_size
+    row["mask_type"] = pref.mask_type
+    row["chara_info_color"] = pref.chara_info_color or "#fee37c"
+    row["show_date"] = pref.show_date
+    row["character_id"] = character_id
+    row["background_id"] = background_id
+    row["frame_id"] = frame_id
+    row["passname_id"] = passname_id
+    return row
+
+
+_SELECT_SOURCE_SEGA_NAMES = text(
+    """
+    SELECT id, sega_name
+    FROM images
+    WHERE sega_name IS NOT NULL AND sega_name <> ''
+    """
+)
+_SELECT_IMAGE_ORIGINAL_NAMES = text(
+    """
+    SELECT id, original_name
+    FROM tbl_image
+    WHERE original_name IS NOT NULL AND original_name <> ''
+    """
+)
 
 
 def _build_image_uuid_lookup(
-    source_conn: Connection, leporid_conn: Connection
+    source_conn: Connection, leporid_conn: Connection, batch_size: int
 ) -> Dict[str, str]:
-    sega_name_by_id = {
-        str(row.id): row.sega_name
-        for row in source_conn.execute(text("SELECT id, sega_name FROM images"))
-        if row.sega_name
-    }
-    if not sega_name_by_id:
-        return {}
-
+    # 两库不在同一实例，无法直接 JOIN：先取目标库 original_name -> id，
+    # 再流式读取源库的 (id, sega_name)，一趟内直接得到匹配结果。
     image_id_by_file_name = {
         row.original_name: str(row.id)
         for row in leporid_conn.execute(
-            text(
-                """
-                SELECT id, original_name
-                FROM tbl_image
-                WHERE original_name IS NOT NULL AND original_name <> ''
-                """
-            )
+            _SELECT_IMAGE_ORIGINAL_NAMES,
+            execution_options=_stream_options(batch_size),
         )
-        if row.original_name
     }
+    if not image_id_by_file_name:
+        return {}
 
     mapping: Dict[str, str] = {}
-    for source_id, sega_name in sega_name_by_id.items():
-        target_id = image_id_by_file_name.get(sega_name)
+    for row in source_conn.execute(
+        _SELECT_SOURCE_SEGA_NAMES, execution_options=_stream_options(batch_size)
+    ):
+        target_id = image_id_by_file_name.get(row.sega_name)
         if target_id:
-            mapping[source_id] = target_id
+            mapping[str(row.id)] = target_id
     return mapping
 
 
-def _resolve_image_reference(value: str, lookup: Mapping[str, str]) -> str:
-    if value in lookup:
-        return lookup[value]
-    if value in uuid_mapping:
-        return uuid_mapping[value]
-    return value
-
-
-def _upsert_preferences(conn: Connection, payload: Sequence[dict]) -> None:
-    conn.execute(
-        text(
-            """
-            INSERT INTO tbl_preference (
-                user_id,
-                maimai_version,
-                simplified_code,
-                character_name,
-                friend_code,
-                display_name,
-                dx_rating,
-                qr_size,
-                mask_type,
-                player_info_color,
-                chara_info_color,
-                show_dx_rating,
-                show_display_name,
-                show_friend_code,
-                show_date,
-                character_id,
-                mask_id,
-                background_id,
-                frame_id,
-                passname_id
-            )
-            VALUES (
-                :user_id,
-                :maimai_version,
-                :simplified_code,
-                :character_name,
-                :friend_code,
-                :display_name,
-                :dx_rating,
-                :qr_size,
-                :mask_type,
-                :player_info_color,
-                :chara_info_color,
-                :show_dx_rating,
-                :show_display_name,
-                :show_friend_code,
-                :show_date,
-                :character_id,
-                :mask_id,
-                :background_id,
-                :frame_id,
-                :passname_id
-            )
-            ON CONFLICT (user_id) DO UPDATE SET
-                maimai_version = EXCLUDED.maimai_version,
-                simplified_code = EXCLUDED.simplified_code,
-                character_name = EXCLUDED.character_name,
-                friend_code = EXCLUDED.friend_code,
-                display_name = EXCLUDED.display_name,
-                dx_rating = EXCLUDED.dx_rating,
-                qr_size = EXCLUDED.qr_size,
-                mask_type = EXCLUDED.mask_type,
-                player_info_color = EXCLUDED.player_info_color,
-                chara_info_color = EXCLUDED.chara_info_color,
-                show_dx_rating = EXCLUDED.show_dx_rating,
-                show_display_name = EXCLUDED.show_display_name,
-                show_friend_code = EXCLUDED.show_friend_code,
-                show_date = EXCLUDED.show_date,
-                character_id = EXCLUDED.character_id,
-                mask_id = EXCLUDED.mask_id,
-                background_id = EXCLUDED.background_id,
-                frame_id = EXCLUDED.frame_id,
-                passname_id = EXCLUDED.passname_id
-            """
-        ),
-        payload,
-    )
+_PREFERENCE_COLUMNS = (
+    "user_id",
+    "maimai_version",
+    "simplified_code",
+    "character_name",
+    "friend_code",
+    "display_name",
+    "dx_rating",
+    "qr_size",
+    "mask_type",
+    "player_info_color",
+    "chara_info_color",
+    "show_dx_rating",
+    "show_display_name",
+    "show_friend_code",
+    "show_date",
+    "character_id",
+    "mask_id",
+    "background_id",
+    "frame_id",
+    "passname_id",
+)
+_PREFERENCE_UPSERT = StagedUpsert(
+    "tbl_preference",
+    _PREFERENCE_COLUMNS,
+    conflict=("user_id",),
+    update=_PREFERENCE_COLUMNS[1:],
+)
+
+
+def _upsert_preferences(conn: Connection, payload: Sequence[dict]) -> int:
+    return _upsert(conn, _PREFERENCE_UPSERT, payload)
 
 
 def _migrate_images(
     *,
-    source_images: Sequence,
+    source_images: Iterable[Row],
     leporid_conn: Connection,
     migrated_users: Mapping[str, MigratedUser],
     batch_size: int,
+    now: datetime,
 ) -> MergeSectionResult:
     summary = MergeSectionResult()
-    existing_ids = {
-        str(row.id) for row in leporid_conn.execute(text("SELECT id FROM tbl_image"))
-    }
+    # kind 只有少数几种取值：每种只解析一次，之后直接查字典；无法识别的缓存其异常
+    aspect_by_kind: Dict[str | None, str | UnknownAspectError] = {}
 
-    payload: List[dict] = []
-    for row in source_images:
-        summary.processed += 1
-        username = str(row.uploaded_by)
-        user = migrated_users.get(username)
-        if user is None:
-            summary.skipped += 1
-            logger.warning("跳过图片 %s：上传者 %s 未迁移", row.id, username)
-            continue
+    # 源库按批读取放到后台线程，主线程转换并写入 leporid 的同时预取后续批次
+    batches = _prefetch(_chunked(source_images, batch_size), depth=2)
 
-        try:
-            aspect_id = derive_aspect_id(row.kind)
-        except UnknownAspectError as exc:
-            summary.skipped += 1
-            logger.warning("图片 %s 跳过：%s", row.id, exc)
-            continue
+    def rows() -> Iterator[tuple]:
+        for row in chain.from_iterable(batches):
+            summary.processed += 1
+            username = str(row.uploaded_by)
+            user = migrated_users.get(username)
+            if user is None:
+                summary.skipped += 1
+                logger.warning("跳过图片 %s：上传者 %s 未迁移", row.id, username)
+                continue
 
-        entry = _adapt_image_row_for_up(
-            row, aspect_id, user.new_user_id, row.uploaded_by is not None
-        )
-        payload.append(entry)
-        if str(row.id) in existing_ids:
-            summary.updated += 1
-        else:
-            summary.inserted += 1
-            existing_ids.add(str(row.id))
+            aspect_id = aspect_by_kind.get(row.kind)
+            if aspect_id is None:
+                try:
+                    aspect_id = derive_aspect_id(row.kind)
+                except UnknownAspectError as exc:
+                    aspect_id = exc
+                aspect_by_kind[row.kind] = aspect_id
+            if isinstance(aspect_id, UnknownAspectError):
+                summary.skipped += 1
+                logger.warning("图片 %s 跳过：%s", row.id, aspect_id)
+                continue
 
-        if len(payload) >= batch_size:
-            _upsert_images(leporid_conn, payload)
-            payload.clear()
+            yield _adapt_image_row_for_up(
+                row, aspect_id, user.new_user_id, row.uploaded_by is not None, now
+            )
 
-    if payload:
-        _upsert_images(leporid_conn, payload)
+    try:
+        for chunk in _chunked(rows(), batch_size):
+            _tally(summary, chunk, _upsert_images(leporid_conn, chunk))
+    finally:
+        # 出错时也要先停下预取线程，之后源库连接才能安全地回滚
+        batches.close()
 
     return summary
 
 
-def _adapt_image_row_for_up(row, aspect_id: str, user_id: str, workshop: bool) -> dict:
-    uploaded_at = _ensure_datetime(row.uploaded_at)
-    labels = build_image_labels(row.kind, row.sega_name, workshop)
-    return {
-        "id": row.id,
-        "user_id": user_id,
-        "aspect_id": aspect_id,
-        "name": build_image_name(row.name, ""),
-        "description": "",
-        "visibility": 0,
-        "labels": labels,
-        "original_name": None,
-        "original_id": None,
-        "created_at": uploaded_at,
-        "updated_at": datetime.utcnow(),
-    }
+def _adapt_image_row_for_up(
+    row, aspect_id: str, user_id: uuid.UUID, workshop: bool, now: datetime
+) -> tuple:
+    # 常见情况是不带时区的时间，直接使用；仅 NULL 或带时区的值才交给 _ensure_datetime
+    uploaded_at = row.uploaded_at
+    if uploaded_at is None or uploaded_at.tzinfo is not None:
+        uploaded_at = _ensure_datetime(uploaded_at, now=now)
+    # 按 _IMAGE_COLUMNS 的顺序返回元组，直接交给暂存表写入；
+    # 源库的 id 是文本，转成 uuid.UUID 后与其余 id 一样按 uuid 类型传输
+    return (
+        uuid.UUID(row.id),
+        user_id,
+        aspect_id,
+        build_image_name(row.name, ""),
+        "",
+        0,
+        build_image_labels(row.kind, row.sega_name, workshop),
+        None,
+        None,
+        uploaded_at,
+        now,
+    )
 
 
-def _upsert_images(conn: Connection, payload: Sequence[dict]) -> None:
-    conn.execute(
-        text(
-            """
-            INSERT INTO tbl_image (
-                id,
-                user_id,
-                aspect_id,
-                name,
-                description,
-                visibility,
-                labels,
-                original_name,
-                original_id,
-                created_at,
-                updated_at
-            )
-            VALUES (
-                :id,
-                :user_id,
-                :aspect_id,
-                :name,
-                :description,
-                :visibility,
-                :labels,
-                :original_name,
-                :original_id,
-                :created_at,
-                :updated_at
-            )
-            ON CONFLICT (id) DO UPDATE SET
-                user_id = EXCLUDED.user_id,
-                aspect_id = EXCLUDED.aspect_id,
-                name = EXCLUDED.name,
-                description = EXCLUDED.description,
-                visibility = EXCLUDED.visibility,
-                labels = EXCLUDED.labels,
-                original_name = EXCLUDED.original_name,
-                original_id = EXCLUDED.original_id,
-                updated_at = EXCLUDED.updated_at
-            """
-        ),
-        payload,
-    )
+_IMAGE_COLUMNS = (
+    "id",
+    "user_id",
+    "aspect_id",
+    "name",
+    "description",
+    "visibility",
+    "labels",
+    "original_name",
+    "original_id",
+    "created_at",
+    "updated_at",
+)
+_IMAGE_UPSERT = StagedUpsert(
+    "tbl_image",
+    _IMAGE_COLUMNS,
+    conflict=("id",),
+    update=_IMAGE_COLUMNS[1:-2] + ("updated_at",),
+    binary=True,
+)
+
+
+def _upsert_images(conn: Connection, payload: Sequence[tuple]) -> int:
+    return _IMAGE_UPSERT.execute(conn, payload)
+
 
+def _upsert(conn: Connection, upsert: StagedUpsert, payload: Sequence[dict]) -> int:
+    # 整批写入暂存表（psycopg 下使用 COPY），再一次性 INSERT ... SELECT ... ON CONFLICT；
+    # itemgetter 在 C 层按列顺序取出每行的值，免去逐列的 Python 循环
+    return upsert.execute(conn, map(itemgetter(*upsert.columns), payload))
 
-def _select_primary_account(
-    prefer_server: str, accounts: Sequence[SourceAccount]
-) -> SourceAccount | None:
+
+def _tally(summary: MergeSectionResult, payload: Sequence, inserted: int) -> None:
+    # 批次内重复键只写入一行，其余按更新计数，与逐行 upsert 的统计一致
+    summary.inserted += inserted
+    summary.updated += len(payload) - inserted
+
+
+def _accounts_by_server(accounts: Sequence[SourceAccount]) -> Dict[str, SourceAccount]:
+    # 同一服务器有多个账号时取第一个，与线性查找的结果一致
+    by_server: Dict[str, SourceAccount] = {}
     for account in accounts:
-        if account.account_server == prefer_server:
-            return account
-    return None
+        by_server.setdefault(account.account_server, account)
+    return by_server
 
 
-def _null_to_empty(value: str | None) -> str:
-    return value or ""
+# 源库布尔列的常见取值（tinyint 0/1、bool、字符串 "0"/"1"）一次字典查找即可转换；
+# True/False 与 1/0 哈希相等，同样命中
+_BOOL_VALUES: Dict[object, bool] = {0: False, 1: True, "0": False, "1": True}
 
 
 def _coerce_bool(value, *, default: bool) -> bool:
     if value is None:
         return default
-    if isinstance(value, bool):
-        return value
+    result = _BOOL_VALUES.get(value)
+    if result is None:
+        return _parse_bool(value)
+    return result
+
+
+@lru_cache(maxsize=64)
+def _parse_bool(value) -> bool:
+    # 字典之外的取值（如 2、"2"）按值缓存 int() 的转换结果；
+    # None 已由调用方按 default 处理，default 无需参与缓存键
     return bool(int(value))
 
 
-def _chunked(sequence: Sequence[dict], size: int) -> Iterator[Sequence[dict]]:
-    chunk: List[dict] = []
-    for item in sequence:
-        chunk.append(item)
-        if len(chunk) >= size:
-            yield chunk
-            chunk = []
-    if chunk:
+def _chunked(source: Iterable[_T], size: int) -> Iterator[Sequence[_T]]:
+    """Split `source` into batches of at most `size` items.
+
+    Generators are consumed lazily, so only one batch is held at a time.
+    """
+    if isinstance(source, Sequence):
+        # 可随机访问的序列直接切片，不必逐个元素追加
+        for start in range(0, len(source), size):
+            yield source[start : start + size]
+        return
+
+    # 生成器等一次性迭代器：每次用 islice 取出一批；批次只读，用元组免去列表的预留空间
+    iterator = iter(source)
+    while chunk := tuple(islice(iterator, size)):
         yield chunk
 
 
-def _create_engine(url: str, *, name: str) -> Engine:
-    engine = create_engine(url, pool_pre_ping=True, future=True)
-    logger.debug("已创建 %s 数据库引擎: %s", name, url)
-    return engine
+def _prefetch(source: Iterable[_T], depth: int) -> Iterator[_T]:
+    """Iterate `source` on a background thread, keeping up to `depth` items ready.
 
+    Exceptions raised by `source` are re-raised to the consumer. Closing the
+    returned generator early stops the producer thread.
+    """
+    items: Queue = Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
 
-def _generate_password_hash() -> str:
+    def produce() -> None:
+        try:
+            for item in source:
+                if stop.is_set():
+                    break
+                items.put((item, None))
+            items.put((done, None))
+        except BaseException as exc:  # 交给消费方重新抛出
+            items.put((done, exc))
+        finally:
+            close = getattr(source, "close", None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce, name="merge-up-prefetch", daemon=True)
+    thread.start()
     try:
-        import importlib  # Delayed import keeps module importable without argon2 installed.
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        # 提前退出时通知生产者停止，并取走队列中的剩余项，避免其阻塞在 put 上
+        stop.set()
+        while thread.is_alive():
+            try:
+                items.get(timeout=0.1)
+            except Empty:
+                pass
+        thread.join()
 
-        argon2_low_level = importlib.import_module("argon2.low_level")
-        hash_secret = argon2_low_level.hash_secret
-        Type = argon2_low_level.Type
-    except ImportError as exc:  # pragma: no cover - 环境缺失依赖时提示
-        raise RuntimeError(
-            "argon2-cffi 未安装，请先执行 `uv sync` 或手动安装依赖后再运行 merge-up"
-        ) from exc
-
-    secret = secrets.token_bytes(32)
-    salt = secrets.token_bytes(16)
-    hashed = hash_secret(
-        secret,
-        salt,
-        time_cost=3,
-        memory_cost=65536,
-        parallelism=4,
-        hash_len=32,
-        type=Type.I,
+
+def _stream_options(batch_size: int) -> dict:
+    # 服务端游标按批拉取，避免驱动把整个结果集缓冲到内存
+    return {"stream_results": True, "yield_per": batch_size}
+
+
+def _create_engine(url: str, *, name: str, config: MergeUpConfig) -> Engine:
+    engine = _engine_for(url, config.batch_size, config.pool_pre_ping)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("使用 %s 数据库引擎: %s", name, url)
+    return engine
+
+
+@lru_cache(maxsize=8)
+def _engine_for(url: str, batch_size: int, pool_pre_ping: bool) -> Engine:
+    # 同一进程内重复迁移（测试、重试）时按 URL 复用引擎，免去重复解析与方言初始化；
+    # 每次运行结束时的 dispose() 只关闭连接池，引擎本身仍可继续使用。
+    # executemany 由驱动批量发送（psycopg 3 走 pipeline），Core insert 的
+    # insertmanyvalues 分页与迁移批次大小保持一致。
+    # 依赖要求 SQLAlchemy 2.x，future 模式即默认行为，无需再传 future=True。
+    return create_engine(
+        url,
+        pool_pre_ping=pool_pre_ping,
+        insertmanyvalues_page_size=batch_size,
+        connect_args=driver_connect_args(url),
     )
-    return hashed.decode("utf-8")
 
 
-def _ensure_datetime(value: datetime | None) -> datetime:
+_ARGON2: tuple | None = None
+
+
+def _get_argon2() -> tuple:
+    """Resolve `(hash_secret, Type)` from argon2 once and reuse it afterwards."""
+    global _ARGON2
+    if _ARGON2 is None:
+        try:
+            import importlib  # Delayed import keeps module importable without argon2 installed.
+
+            argon2_low_level = importlib.import_module("argon2.low_level")
+        except ImportError as exc:  # pragma: no cover - 环境缺失依赖时提示
+            raise RuntimeError(
+                "argon2-cffi 未安装，请先执行 `uv sync` 或手动安装依赖后再运行 merge-up"
+            ) from exc
+        _ARGON2 = (argon2_low_level.hash_secret, argon2_low_level.Type)
+    return _ARGON2
+
+
+@contextmanager
+def _password_hashes(
+    unique: bool, batch_size: int, options: Mapping[str, int]
+) -> Iterator[Iterator[str]]:
+    """Provide placeholder password hashes for migrated users, one per `next()`.
+
+    Migrated users cannot log in with their old passwords, so by default they all
+    share one random hash computed once per run. With `unique`, every user gets
+    a hash of its own, computed in batches across worker threads.
+    """
+    kwargs = _argon2_kwargs(options)
+    if not unique:
+        yield repeat(_generate_password_hash(kwargs))
+        return
+
+    # argon2-cffi 调用 C 函数期间释放 GIL，线程即可并行哈希，
+    # 免去进程池的启动开销与逐个结果的序列化。
+    # 每个哈希自身会使用 parallelism 个线程，线程池按此缩小以免超额占用 CPU
+    workers = max(1, (os.cpu_count() or 1) // options["parallelism"])
+    with ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="merge-up-argon2"
+    ) as pool:
+        hashes = _hash_batches(pool, batch_size, workers, kwargs)
+        try:
+            yield hashes
+        finally:
+            # 关闭生成器会取消尚未开始的哈希任务，避免退出时白白算完最后一批
+            hashes.close()
+
+
+def _hash_batches(
+    pool: Executor, batch_size: int, workers: int, kwargs: Mapping[str, object]
+) -> Iterator[str]:
+    def submit(size: int) -> List[Future[List[str]]]:
+        # 每批按线程数切分，每个任务一次算出一段哈希，而不是每个哈希提交一次任务
+        share, extra = divmod(size, workers)
+        counts = [share + 1] * extra + ([share] * (workers - extra) if share else [])
+        return [
+            pool.submit(_generate_password_hashes, count, kwargs) for count in counts
+        ]
+
+    # 首批在第一次取用时才提交，且从每个线程一个哈希起步、逐批翻倍到 batch_size；
+    # 本批取用过半后才提交下一批，主线程写入用户的同时线程池在计算下一批，
+    # 只迁移少量用户时也不会预先算出成批用不到的哈希
+    size = min(workers, batch_size)
+    current = submit(size)
+    ahead: List[Future[List[str]]] = []
+    try:
+        while True:
+            next_size = min(size * 2, batch_size)
+            remaining = size
+            for future in current:
+                for password_hash in future.result():
+                    yield password_hash
+                    remaining -= 1
+                    if not ahead and remaining <= size // 2:
+                        ahead = submit(next_size)
+            current, ahead, size = ahead, [], next_size
+    finally:
+        for future in chain(current, ahead):
+            future.cancel()
+
+
+def _argon2_kwargs(options: Mapping[str, int]) -> Dict[str, object]:
+    # hash_secret 的关键字参数（含 Type.I）每次运行只构造一次，逐个哈希直接复用
+    _, Type = _get_argon2()
+    return {**options, "type": Type.I}
+
+
+def _generate_password_hash(kwargs: Mapping[str, object]) -> str:
+    hash_secret, _ = _get_argon2()
+    # 一次取出 48 字节随机数，前 32 字节作占位密码，后 16 字节作盐
+    random_bytes = secrets.token_bytes(48)
+    secret, salt = random_bytes[:32], random_bytes[32:]
+    # argon2 编码结果只含 ASCII 字符，按 ASCII 解码走更快的路径
+    return hash_secret(secret, salt, **kwargs).decode("ascii")
+
+
+def _generate_password_hashes(count: int, kwargs: Mapping[str, object]) -> List[str]:
+    hash_secret, _ = _get_argon2()
+    # 整段任务的随机数一次取出再按 48 字节切分（前 32 字节作占位密码，后 16 字节作盐）
+    random_bytes = secrets.token_bytes(48 * count)
+    return [
+        hash_secret(
+            random_bytes[offset : offset + 32],
+            random_bytes[offset + 32 : offset + 48],
+            **kwargs,
+        ).decode("ascii")
+        for offset in range(0, 48 * count, 48)
+    ]
+
+
+def _utcnow() -> datetime:
+    # 目标库的时间列均为不带时区的 UTC 时间
+    return datetime.now(_UTC).replace(tzinfo=None)
+
+
+def _ensure_datetime(
+    value: datetime | None, *, now: datetime | None = None
+) -> datetime:
     if value is None:
-        return datetime.utcnow()
-    if value.tzinfo:
-        return value.astimezone(timezone.utc).replace(tzinfo=None)
-    return value
+        return now if now is not None else _utcnow()
+    tz = value.tzinfo
+    if tz is None:
+        return value
+    if tz is _UTC:
+        # 已是 UTC，直接去掉时区即可，无需 astimezone 换算
+        return value.replace(tzinfo=None)
+    return value.astimezone(_UTC).replace(tzinfo=None)
 
 
 __all__ = [
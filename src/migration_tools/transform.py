@@ -1,15 +1,13 @@
 from __future__ import annotations
 
+import os
+import uuid
 from dataclasses import dataclass
-from typing import Iterable, List, Optional
+from typing import Iterable, Iterator, List, Optional
 
-_KIND_TO_ASPECT = {
-    "BACKGROUND": "id-1-ff",
-    "FRAME": "id-1-ff",
-    "CHARACTER": "id-1-ff",
-    "MASK": "id-1-ff",
-    "LABEL": "id-1-ff",
-}
+# 目前所有已知的图片类型都使用同一种比例，只需判断 kind 是否已知
+_KNOWN_KINDS = frozenset({"BACKGROUND", "FRAME", "CHARACTER", "MASK", "LABEL"})
+_ASPECT_ID = "id-1-ff"
 
 
 class UnknownAspectError(ValueError):
@@ -18,10 +16,9 @@ class UnknownAspectError(ValueError):
 
 def derive_aspect_id(kind: str) -> str:
     """Map the legacy `kind` enum to the correct aspect identifier."""
-    key = (kind or "").upper()
-    if key not in _KIND_TO_ASPECT:
+    if not kind or kind.upper() not in _KNOWN_KINDS:
         raise UnknownAspectError(f"未识别的图片类型: {kind!r}")
-    return _KIND_TO_ASPECT[key]
+    return _ASPECT_ID
 
 
 def build_image_labels(kind: str, category: Optional[str], workshop: bool) -> List[str]:
@@ -48,6 +45,14 @@ def build_image_name(label: Optional[str], trace_id: Optional[str]) -> str:
     return name
 
 
+def uuid4_stream(batch_size: int = 1024) -> Iterator[uuid.UUID]:
+    """Yield random version-4 UUIDs, reading entropy from os.urandom in bulk."""
+    while True:
+        pool = os.urandom(16 * batch_size)
+        for offset in range(0, len(pool), 16):
+            yield uuid.UUID(bytes=pool[offset : offset + 16], version=4)
+
+
 @dataclass(slots=True)
 class MergeSectionResult:
     """Per-section migration counters."""
@@ -64,4 +69,5 @@ __all__ = [
     "build_image_labels",
     "build_image_name",
     "derive_aspect_id",
+    "uuid4_stream",
 ]
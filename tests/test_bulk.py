@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+from types import SimpleNamespace
+
+from migration_tools.bulk import StagedUpsert, supports_copy
+
+
+class _RecordingConnection:
+    """Stands in for a non-psycopg connection and records executed statements."""
+
+    dialect = SimpleNamespace(name="sqlite", driver="pysqlite")
+
+    def __init__(self, inserted: int = 0) -> None:
+        self.calls: list[tuple[str, object]] = []
+        self._inserted = inserted
+
+    def execute(self, statement, parameters=None):
+        self.calls.append((str(statement), parameters))
+        return SimpleNamespace(scalar_one=lambda: self._inserted)
+
+
+def test_merge_sql_without_match_dedupes_on_conflict_key() -> None:
+    upsert = StagedUpsert(
+        "tbl_rating",
+        ("user_id", "name", "rating"),
+        conflict=("user_id",),
+        update=("name", "rating"),
+    )
+    sql = str(upsert._merge)
+
+    assert upsert.stage == "tbl_rating_stage"
+    # 同一批次内重复键时保留写入顺序最靠后的一行
+    assert "SELECT DISTINCT ON (s.user_id) s.user_id, s.name, s.rating" in sql
+    assert "FROM tbl_rating_stage s ORDER BY s.user_id, s._ord DESC" in sql
+    assert (
+        "ON CONFLICT (user_id) DO UPDATE SET name = EXCLUDED.name, rating = EXCLUDED.rating"
+        in sql
+    )
+    assert "LEFT JOIN" not in sql
+    assert "RETURNING (xmax = 0) AS inserted" in sql
+    assert sql.endswith("SELECT count(*) FILTER (WHERE inserted) FROM upserted")
+
+
+def test_merge_sql_with_match_reuses_existing_id() -> None:
+    upsert = StagedUpsert(
+        "tbl_account",
+        ("id", "user_id", "server_id", "credentials"),
+        conflict=("id",),
+        update=("credentials",),
+        match=("user_id", "server_id"),
+    )
+    sql = str(upsert._merge)
+
+    assert (
+        "SELECT DISTINCT ON (s.user_id, s.server_id) "
+        "COALESCE(e.id, s.id), s.user_id, s.server_id, s.credentials" in sql
+    )
+    assert (
+        "FROM tbl_account_stage s LEFT JOIN tbl_account e "
+        "ON e.user_id = s.user_id AND e.server_id = s.server_id" in sql
+    )
+    assert "ORDER BY s.user_id, s.server_id, s._ord DESC" in sql
+    assert "ON CONFLICT (id) DO UPDATE SET credentials = EXCLUDED.credentials" in sql
+
+
+def test_merge_sql_without_update_does_nothing_on_conflict() -> None:
+    upsert = StagedUpsert(
+        "tbl_image_aspect", ("id", "name"), conflict=("id",), update=()
+    )
+    sql = str(upsert._merge)
+
+    assert "ON CONFLICT (id) DO NOTHING RETURNING (xmax = 0) AS inserted" in sql
+    assert "DO UPDATE" not in sql
+
+
+def test_stage_statements_copy_column_types_only() -> None:
+    upsert = StagedUpsert(
+        "tbl_rating", ("user_id", "name"), conflict=("user_id",), update=("name",)
+    )
+
+    create_sql, truncate_sql = upsert._reset_stage
+    assert create_sql == (
+        "CREATE TEMP TABLE IF NOT EXISTS tbl_rating_stage ON COMMIT DROP AS "
+        "SELECT user_id, name, CAST(NULL AS bigint) AS _ord FROM tbl_rating WITH NO DATA"
+    )
+    assert truncate_sql == "TRUNCATE tbl_rating_stage"
+    assert (
+        upsert._copy_stage == "COPY tbl_rating_stage (user_id, name, _ord) FROM STDIN"
+    )
+
+
+def test_execute_falls_back_to_executemany() -> None:
+    upsert = StagedUpsert(
+        "tbl_rating", ("user_id", "name"), conflict=("user_id",), update=("name",)
+    )
+    conn = _RecordingConnection(inserted=1)
+    assert not supports_copy(conn)  # type: ignore[arg-type]
+
+    rows = [("u1", "a"), ("u2", "b"), ("u1", "c")]
+    inserted = upsert.execute(conn, rows)  # type: ignore[arg-type]
+
+    assert inserted == 1
+    statements = [sql for sql, _ in conn.calls]
+    assert statements[0].startswith("CREATE TEMP TABLE IF NOT EXISTS tbl_rating_stage")
+    assert statements[1] == "TRUNCATE tbl_rating_stage"
+    assert statements[2] == (
+        "INSERT INTO tbl_rating_stage (user_id, name, _ord) VALUES (:p0, :p1, :_ord)"
+    )
+    # 每行带上写入序号，合并时据此保留最后一行
+    assert conn.calls[2][1] == [
+        {"p0": "u1", "p1": "a", "_ord": 0},
+        {"p0": "u2", "p1": "b", "_ord": 1},
+        {"p0": "u1", "p1": "c", "_ord": 2},
+    ]
+    assert statements[3] == str(upsert._merge)
+    assert len(conn.calls) == 4
+
+
+def test_execute_skips_stage_insert_for_empty_batch() -> None:
+    upsert = StagedUpsert(
+        "tbl_rating", ("user_id", "name"), conflict=("user_id",), update=("name",)
+    )
+    conn = _RecordingConnection()
+
+    assert upsert.execute(conn, []) == 0  # type: ignore[arg-type]
+    assert not any(
+        sql.startswith("INSERT INTO tbl_rating_stage") for sql, _ in conn.calls
+    )
+
+
+def test_binary_copy_statements() -> None:
+    upsert = StagedUpsert(
+        "tbl_image", ("id", "labels"), conflict=("id",), update=("labels",), binary=True
+    )
+
+    assert upsert.binary
+    assert upsert._copy_stage_binary == (
+        "COPY tbl_image_stage (id, labels, _ord) FROM STDIN (FORMAT BINARY)"
+    )
+    # 二进制 COPY 的列类型取自暂存表本身，按列号排列
+    assert upsert._select_stage_types == (
+        "SELECT atttypid FROM pg_attribute "
+        "WHERE attrelid = 'tbl_image_stage'::regclass "
+        "AND attnum > 0 AND NOT attisdropped ORDER BY attnum"
+    )
+
+
+def test_execute_fallback_ignores_binary() -> None:
+    upsert = StagedUpsert(
+        "tbl_image", ("id", "labels"), conflict=("id",), update=("labels",), binary=True
+    )
+    conn = _RecordingConnection()
+
+    upsert.execute(conn, [("i1", ["a"])])  # type: ignore[arg-type]
+
+    statements = [sql for sql, _ in conn.calls]
+    assert not any("COPY" in sql or "pg_attribute" in sql for sql in statements)
+    assert conn.calls[2][1] == [{"p0": "i1", "p1": ["a"], "_ord": 0}]
@@ -82,3 +82,35 @@ def test_copy_images_skips_when_target_exists(tmp_path) -> None:
     assert stats.skipped_missing == 0
     assert stats.skipped_existing == 1
     assert dst_path.read_bytes() == b"old-data"
+
+
+def test_copy_images_overwrites_when_requested(tmp_path) -> None:
+    source_dir = tmp_path / "src"
+    target_dir = tmp_path / "dst"
+    db_path = tmp_path / "db.sqlite"
+
+    source_dir.mkdir()
+    target_dir.mkdir()
+
+    image_id = str(uuid4())
+    src_path = source_dir / f"{image_id}.webp"
+    dst_path = target_dir / f"{image_id}.webp"
+
+    src_path.write_bytes(b"new-data")
+    dst_path.write_bytes(b"stale-and-longer-data")
+
+    _init_db(db_path, [image_id])
+
+    engine = create_engine(f"sqlite+pysqlite:///{db_path}", future=True)
+    with engine.connect() as conn:
+        stats = copy_img._copy_images(
+            conn=conn,
+            source_dir=source_dir,
+            target_dir=target_dir,
+            overwrite=True,
+        )
+
+    assert stats.processed == 1
+    assert stats.copied == 1
+    assert stats.skipped_existing == 0
+    assert dst_path.read_bytes() == b"new-data"
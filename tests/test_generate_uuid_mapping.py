@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("PIL")
+
+from migration_tools.external import generate_uuid_mapping as gum  # noqa: E402
+
+
+def _hashes_with_near_duplicates(
+    rng, count: int, flips: int
+) -> tuple[np.ndarray, np.ndarray]:
+    a = rng.integers(0, 2**63, size=count, dtype=np.int64).astype(np.uint64) << 1
+    b = a.copy()
+    for index in range(count):
+        for bit in rng.choice(64, size=rng.integers(0, flips + 1), replace=False):
+            b[index] ^= np.uint64(1) << np.uint64(bit)
+    # 打乱 B 的顺序并混入完全随机的哈希，保证既有命中也有落空
+    noise = rng.integers(0, 2**63, size=count, dtype=np.int64).astype(np.uint64)
+    b = np.concatenate([b, noise])
+    rng.shuffle(b)
+    return a, b
+
+
+def _brute_force_match(
+    a_keys, b_keys, a_metrics, b_metrics, max_hamming, hist_threshold
+) -> dict:
+    # 逐对比较的参考实现：先按 Hamming 距离贪心，再用直方图 L1 距离回退
+    a_hashes, a_hists = a_metrics
+    b_hashes, b_hists = b_metrics
+    pairs = sorted(
+        (
+            (gum.hamming_distance(int(ah), int(bh)), i, j)
+            for i, ah in enumerate(a_hashes)
+            for j, bh in enumerate(b_hashes)
+        ),
+        key=lambda pair: pair[0],
+    )
+    mapping = {}
+    taken_b = set()
+    for d, i, j in pairs:
+        if d <= max_hamming and a_keys[i] not in mapping and j not in taken_b:
+            mapping[a_keys[i]] = b_keys[j]
+            taken_b.add(j)
+
+    remaining_b = [j for j in range(len(b_keys)) if j not in taken_b]
+    for i, a in enumerate(a_keys):
+        if a in mapping or not remaining_b:
+            continue
+        scores = [float(np.abs(a_hists[i] - b_hists[j]).sum()) for j in remaining_b]
+        best = min(range(len(scores)), key=scores.__getitem__)
+        if scores[best] <= hist_threshold:
+            mapping[a] = b_keys[remaining_b.pop(best)]
+    return mapping
+
+
+@pytest.mark.parametrize("max_hamming", [0, 3, 7])
+def test_candidate_pairs_bucket_matches_full_scan(monkeypatch, max_hamming) -> None:
+    rng = np.random.default_rng(max_hamming)
+    a, b = _hashes_with_near_duplicates(rng, 200, max_hamming + 2)
+    # 小块尺寸让两条路径都跨越多个分块
+    monkeypatch.setattr(gum, "_BLOCK_CELLS", 1000)
+
+    bucket = gum.candidate_pairs(a, b, max_hamming)
+    monkeypatch.setattr(gum, "_MIN_SEGMENT_BITS", 65)
+    scan = gum.candidate_pairs(a, b, max_hamming)
+
+    assert len(scan[0]) > 0
+    for got, expected in zip(bucket, scan):
+        np.testing.assert_array_equal(got, expected)
+
+
+@pytest.mark.parametrize("max_hamming", [2, 10])
+def test_greedy_match_matches_brute_force(monkeypatch, max_hamming) -> None:
+    rng = np.random.default_rng(max_hamming)
+    a_hashes, b_hashes = _hashes_with_near_duplicates(rng, 30, 12)
+    # 直方图取 1/8 的整数倍，浮点求和与顺序无关，两种实现的距离完全一致
+    a_hists = rng.integers(0, 3, size=(len(a_hashes), 24)).astype(np.float32) / 8
+    b_hists = rng.integers(0, 3, size=(len(b_hashes), 24)).astype(np.float32) / 8
+    a_keys = [f"a{i}" for i in range(len(a_hashes))]
+    b_keys = [f"b{j}" for j in range(len(b_hashes))]
+    monkeypatch.setattr(gum, "_BLOCK_CELLS", 500)
+
+    args = (a_keys, b_keys, (a_hashes, a_hists), (b_hashes, b_hists))
+    expected = _brute_force_match(*args, max_hamming, 1.5)
+    assert gum.greedy_match(*args, max_hamming, 1.5) == expected
+    # 阈值让回退既有接受也有拒绝
+    assert 0 < len(expected) < len(a_keys)
+
+
+@pytest.mark.parametrize("mode", ["P", "1", "I;16"])
+def test_load_image_metrics_accepts_non_reducible_modes(tmp_path, mode) -> None:
+    from PIL import Image
+
+    path = tmp_path / "image.png"
+    Image.linear_gradient("L").resize((400, 300)).convert(mode).save(path)
+
+    uuid, dh, hist = gum.load_image_metrics(("uuid-1", str(path)))
+
+    assert uuid == "uuid-1"
+    assert 0 <= dh < 2**64
+    assert hist.shape == (24,)
+    assert hist.sum() == pytest.approx(1.0)
+
+
+@pytest.mark.parametrize("hash_size", [0, 4, 12])
+def test_dhash_rejects_sizes_that_do_not_pack_into_bytes(hash_size) -> None:
+    from PIL import Image
+
+    with pytest.raises(ValueError, match="multiple of 8"):
+        gum.dhash(Image.new("L", (32, 32)), hash_size=hash_size)
+
+
+def test_dhash_packs_hash_size_squared_bits() -> None:
+    from PIL import Image
+
+    image = Image.linear_gradient("L").rotate(90)
+    assert 0 <= gum.dhash(image) < 2**64
+    assert 0 <= gum.dhash(image, hash_size=16) < 2**256
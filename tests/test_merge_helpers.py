@@ -1,14 +1,18 @@
 from __future__ import annotations
 
+import uuid
 from datetime import datetime
 from types import SimpleNamespace
 
+import pytest
+from sqlalchemy import create_engine, text
+
 from migration_tools import merge
 
 
 def test_adapt_image_row_assigns_user_and_visibility() -> None:
     row = SimpleNamespace(
-        uuid="uuid-1",
+        uuid="aaaaaaaa-1111-4111-8111-111111111111",
         kind="BACKGROUND",
         label=None,
         file_name="legacy.png",
@@ -17,12 +21,65 @@ def test_adapt_image_row_assigns_user_and_visibility() -> None:
         trace_id="trace-123",
     )
 
-    entry = merge._adapt_image_row(row, "id-1-ff", 42, 1)  # type: ignore[arg-type]
+    now = datetime(2024, 6, 1, 12, 0, 0)
+
+    entry = merge._adapt_image_row(
+        row, "id-1-ff", 42, 1, False, now  # type: ignore[arg-type]
+    )
 
-    assert entry["uuid"] == "uuid-1"
+    assert entry["id"] == uuid.UUID("aaaaaaaa-1111-4111-8111-111111111111")
+    assert entry["uuid"] == "aaaaaaaa-1111-4111-8111-111111111111"
     assert entry["user_id"] == 42
     assert entry["visibility"] == 1
     assert entry["aspect_id"] == "id-1-ff"
     assert entry["original_id"] == "trace-123"
-    assert entry["file_name"] == "legacy.png"
+    assert entry["original_name"] == "legacy.png"
     assert entry["labels"] == ["background"]
+    assert entry["created_at"] == datetime(2024, 1, 2, 3, 4, 5)
+    assert entry["updated_at"] == now
+
+
+_ADMIN_ID = "00000000-0000-4000-8000-0000000000aa"
+
+
+def _merge_images_with_admin(admin_user_id: str) -> merge.MergeSectionResult:
+    # 目标库的 id 列用文本存储，模拟驱动不返回 uuid.UUID 的情况
+    engine = create_engine("sqlite+pysqlite:///:memory:")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE users (id INTEGER, username TEXT)"))
+        conn.execute(
+            text(
+                "CREATE TABLE images (uuid TEXT, kind TEXT, label TEXT, file_name TEXT, "
+                "uploaded_by INTEGER, uploaded_at TIMESTAMP, category TEXT, trace_id TEXT)"
+            )
+        )
+        conn.execute(text("CREATE TABLE tbl_user (id TEXT, username TEXT)"))
+        conn.execute(
+            text(
+                "CREATE TABLE tbl_image_aspect (id TEXT PRIMARY KEY, name TEXT, "
+                "description TEXT, ratio_width_unit INTEGER, ratio_height_unit INTEGER)"
+            )
+        )
+        conn.execute(
+            text("INSERT INTO tbl_user VALUES (:id, 'admin')"), {"id": _ADMIN_ID}
+        )
+        return merge.merge_images(
+            source_conn=conn,
+            target_conn=conn,
+            batch_size=10,
+            admin_user_id=admin_user_id,
+        )
+
+
+def test_merge_images_accepts_admin_stored_as_text() -> None:
+    assert _merge_images_with_admin(_ADMIN_ID.upper()).processed == 0
+
+
+def test_merge_images_rejects_invalid_admin_id() -> None:
+    with pytest.raises(ValueError, match="不是合法的 UUID"):
+        _merge_images_with_admin("not-a-uuid")
+
+
+def test_merge_images_rejects_unknown_admin_id() -> None:
+    with pytest.raises(ValueError, match="不存在于目标库"):
+        _merge_images_with_admin("00000000-0000-4000-8000-0000000000bb")
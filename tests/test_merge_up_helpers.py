@@ -1,7 +1,10 @@
 from __future__ import annotations
 
+from concurrent.futures import Future
 from datetime import datetime
 
+from sqlalchemy import create_engine, text
+
 from migration_tools import merge_up
 
 
@@ -34,13 +37,25 @@ def _make_user(
     )
 
 
-def test_select_primary_account_matches_preference() -> None:
+def test_accounts_by_server_matches_preference() -> None:
     accounts = [_make_account(server="LXNS"), _make_account(server="DIVING_FISH")]
-    result = merge_up._select_primary_account("DIVING_FISH", accounts)
+    result = merge_up._accounts_by_server(accounts).get("DIVING_FISH")
     assert result is not None
     assert result.account_server == "DIVING_FISH"
 
 
+def test_accounts_by_server_keeps_first_account_per_server() -> None:
+    first = _make_account(username="first", server="LXNS")
+    second = _make_account(username="second", server="LXNS")
+    other = _make_account(server="DIVING_FISH")
+
+    by_server = merge_up._accounts_by_server([first, other, second])
+
+    assert by_server == {"LXNS": first, "DIVING_FISH": other}
+    # 回退时按首次出现的顺序遍历服务器
+    assert list(by_server) == ["LXNS", "DIVING_FISH"]
+
+
 def test_build_preference_row_defaults_when_missing() -> None:
     account = _make_account()
     user = _make_user()
@@ -100,3 +115,132 @@ def test_build_preference_row_respects_existing_values() -> None:
     assert row["background_id"] == "bg-1"
     assert row["chara_info_color"] == "#fee37c"
     assert row["show_date"] is False
+
+
+def test_chunked_slices_sequences() -> None:
+    chunks = list(merge_up._chunked([1, 2, 3, 4, 5], 2))
+    assert chunks == [[1, 2], [3, 4], [5]]
+    assert list(merge_up._chunked([], 2)) == []
+
+
+def test_chunked_consumes_iterators_lazily() -> None:
+    pulled: list[int] = []
+
+    def source():
+        for value in range(5):
+            pulled.append(value)
+            yield value
+
+    chunks = merge_up._chunked(source(), 2)
+    assert next(chunks) == (0, 1)
+    # 只取出第一批所需的元素
+    assert pulled == [0, 1]
+    assert list(chunks) == [(2, 3), (4,)]
+
+
+class _SyncPool:
+    """Runs submitted tasks immediately and remembers how many hashes were requested."""
+
+    def __init__(self) -> None:
+        self.requested: list[int] = []
+
+    def submit(self, fn, count, kwargs):
+        self.requested.append(count)
+        future: Future = Future()
+        future.set_result(fn(count, kwargs))
+        return future
+
+
+def test_hash_batches_only_computes_what_is_pulled(monkeypatch) -> None:
+    monkeypatch.setattr(
+        merge_up,
+        "_generate_password_hashes",
+        lambda count, kwargs: [f"hash-{count}"] * count,
+    )
+    pool = _SyncPool()
+
+    hashes = merge_up._hash_batches(pool, 5000, 2, {})  # type: ignore[arg-type]
+    # 生成器在第一次取用前不提交任何任务
+    assert pool.requested == []
+
+    pulled = [next(hashes) for _ in range(3)]
+    hashes.close()
+
+    assert len(pulled) == 3
+    # 批次从每个线程一个哈希起步逐批翻倍，远少于一整批 batch_size
+    assert sum(pool.requested) <= 8
+
+
+def test_hash_batches_grow_up_to_batch_size(monkeypatch) -> None:
+    monkeypatch.setattr(
+        merge_up,
+        "_generate_password_hashes",
+        lambda count, kwargs: [f"hash-{count}"] * count,
+    )
+    pool = _SyncPool()
+
+    hashes = merge_up._hash_batches(pool, 8, 2, {})  # type: ignore[arg-type]
+    pulled = [next(hashes) for _ in range(30)]
+    hashes.close()
+
+    assert len(pulled) == 30
+    assert max(pool.requested) == 4
+    # 已取用的哈希之外最多只多算出一批
+    assert sum(pool.requested) <= 30 + 8
+
+
+def test_load_source_users_ignores_duplicate_preference_rows() -> None:
+    engine = create_engine("sqlite+pysqlite:///:memory:")
+    with engine.connect() as conn:
+        conn.execute(
+            text(
+                "CREATE TABLE users (username TEXT, prefer_server TEXT, "
+                "created_at TIMESTAMP, updated_at TIMESTAMP)"
+            )
+        )
+        conn.execute(
+            text(
+                "CREATE TABLE user_accounts (username TEXT, account_name TEXT, "
+                "account_server TEXT, account_password TEXT, nickname TEXT, "
+                "bind_qq TEXT, player_rating INTEGER, "
+                "created_at TIMESTAMP, updated_at TIMESTAMP)"
+            )
+        )
+        conn.execute(
+            text(
+                "CREATE TABLE user_preferences (username TEXT, maimai_version TEXT, "
+                "simplified_code TEXT, character_name TEXT, friend_code TEXT, "
+                "display_name TEXT, dx_rating TEXT, qr_size INTEGER, "
+                "mask_type INTEGER, character_id TEXT, background_id TEXT, "
+                "frame_id TEXT, passname_id TEXT, chara_info_color TEXT, "
+                "show_date INTEGER)"
+            )
+        )
+        conn.execute(text("INSERT INTO users VALUES ('alice', 'LXNS', NULL, NULL)"))
+        conn.execute(
+            text(
+                "INSERT INTO user_accounts (username, account_name, account_server) "
+                "VALUES ('alice', 'alice_df', 'DIVING_FISH'), "
+                "('alice', 'alice_lx', 'LXNS')"
+            )
+        )
+        # 同一用户的两行偏好设置不应让账号行成倍重复
+        conn.execute(
+            text(
+                "INSERT INTO user_preferences (username, maimai_version, qr_size) "
+                "VALUES ('alice', 'A', 20), ('alice', 'B', 0)"
+            )
+        )
+
+        preferences: dict = {}
+        now = datetime(2024, 1, 1)
+        loaded = list(merge_up._load_source_users(conn, 10, preferences, now))
+
+    assert len(loaded) == 1
+    user, accounts = loaded[0]
+    assert user.created_at == now
+    assert [account.account_name for account in accounts] == [
+        "alice_df",
+        "alice_lx",
+    ]
+    assert preferences["alice"].maimai_version in {"A", "B"}
@@ -0,0 +1,17 @@
+from __future__ import annotations
+
+import uuid
+from itertools import islice
+
+from migration_tools.transform import uuid4_stream
+
+
+def test_uuid4_stream_yields_distinct_version4_uuids() -> None:
+    # 批次设得很小，让生成过程跨越多次 os.urandom 读取
+    ids = list(islice(uuid4_stream(batch_size=3), 10))
+
+    assert len(set(ids)) == 10
+    for value in ids:
+        assert isinstance(value, uuid.UUID)
+        assert value.version == 4
+        assert value.variant == uuid.RFC_4122